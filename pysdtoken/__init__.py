@@ -1 +1,3 @@
 from .pysdtoken import SDProcess
+from ._watchdog import ServiceUnavailableError, CallTimeoutError, QueueTimeoutError, CircuitOpenError
+from ._scheduler import DeadlineExceededError
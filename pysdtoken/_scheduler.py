@@ -0,0 +1,234 @@
+"""
+Priority and deadline scheduling for token service calls
+Interactive requests (logins) and batch work (expiry audits, mass code exports) share one token service. The
+scheduler admits a limited number of DLL calls at a time. Waiting interactive requests always go first, batch
+requests are shared round-robin between jobs, and requests whose deadline passes while they wait are dropped
+with DeadlineExceededError instead of being run.
+
+    with sd.request_options(priority='batch', timeout=5.0, job='expiry-audit'):
+        token.get_expiration_date()
+"""
+from __future__ import annotations
+import threading
+import time
+from collections import deque, OrderedDict
+from contextvars import ContextVar
+from typing import Any, Deque, Dict, NamedTuple, Optional, Tuple
+from ._watchdog import ServiceUnavailableError
+
+PRIORITY_INTERACTIVE: str = 'interactive'
+PRIORITY_BATCH: str = 'batch'
+# Highest priority first
+PRIORITIES: Tuple[str, ...] = (PRIORITY_INTERACTIVE, PRIORITY_BATCH)
+
+
+class DeadlineExceededError(ServiceUnavailableError):
+    """
+    The request's deadline passed before it could be run
+    """
+    pass
+
+
+class RequestOptions(NamedTuple):
+    """
+    Scheduling options for the DLL calls made in a context
+    :param priority: one of PRIORITIES
+    :param deadline: time.monotonic() after which the request is dropped, or None
+    :param job: requests of the same batch job share one fair-share slot. Defaults to the calling thread.
+    """
+    priority: str = PRIORITY_INTERACTIVE
+    deadline: Optional[float] = None
+    job: Any = None
+
+
+# Set with SDProcess.request_options. Untagged requests are interactive with no deadline.
+current_request_options: ContextVar[RequestOptions] = ContextVar(
+    'pysdtoken_request_options', default=RequestOptions()
+)
+
+# True while this context holds a slot. DLL calls nested in it (e.g. from a trace hook) run in the same slot instead
+# of waiting for one they could never get.
+_slot_held: ContextVar[bool] = ContextVar('pysdtoken_slot_held', default=False)
+
+
+class _Waiter:
+    __slots__ = ('priority', 'deadline', 'job', 'enqueued', 'event', 'admitted', 'dropped')
+
+    def __init__(self, priority: str, deadline: Optional[float], job: Any):
+        self.priority = priority
+        self.deadline = deadline
+        self.job = job
+        self.enqueued = time.monotonic()
+        self.event = threading.Event()
+        self.admitted = False
+        self.dropped = False
+
+
+class _ClassStats:
+    __slots__ = ('admitted', 'dropped', 'wait_total', 'wait_max')
+
+    def __init__(self):
+        self.admitted: int = 0
+        self.dropped: int = 0
+        self.wait_total: float = 0.0
+        self.wait_max: float = 0.0
+
+
+class RequestScheduler:
+    """
+    Admits at most max_concurrent DLL calls at a time in priority, fair-share and deadline order
+    :param max_concurrent: number of DLL calls allowed in flight
+    """
+
+    def __init__(self, max_concurrent: int = 1):
+        if max_concurrent < 1:
+            raise ValueError(f"Invalid max concurrent calls {max_concurrent}")
+        self.max_concurrent = max_concurrent
+        self._lock = threading.Lock()
+        self._running: int = 0
+        self._interactive: Deque[_Waiter] = deque()
+        # job -> waiting batch requests. The order of the keys is the round-robin order.
+        self._batch: OrderedDict = OrderedDict()
+        self._stats: Dict[str, _ClassStats] = {priority: _ClassStats() for priority in PRIORITIES}
+
+    def slot(self, options: RequestOptions) -> _Slot:
+        """
+        Context manager that waits for a turn to call the DLL. Reentrant: nested in a held slot it doesn't wait.
+        :raises DeadlineExceededError: when the deadline passes before the request is admitted
+        """
+        if options.priority not in PRIORITIES:
+            raise ValueError(f"Invalid priority {options.priority}. Not in {PRIORITIES}")
+        return _Slot(self, options)
+
+    def _acquire(self, options: RequestOptions) -> None:
+        job = options.job if options.job is not None else threading.current_thread().name
+        waiter = _Waiter(options.priority, options.deadline, job)
+        with self._lock:
+            if self._expired(waiter, waiter.enqueued):
+                self._drop(waiter)
+            elif self._running < self.max_concurrent and not self._queue_depth():
+                self._admit(waiter, waiter.enqueued)
+                return
+            else:
+                self._enqueue(waiter)
+
+        if not waiter.dropped:
+            timeout = None if waiter.deadline is None else max(0.0, waiter.deadline - time.monotonic())
+            waiter.event.wait(timeout)
+            with self._lock:
+                if not waiter.admitted and not waiter.dropped:
+                    # Deadline passed while waiting
+                    self._remove(waiter)
+                    self._drop(waiter)
+        if waiter.dropped:
+            raise DeadlineExceededError(f"Deadline passed before the {waiter.priority} request could run")
+
+    def _release(self) -> None:
+        with self._lock:
+            self._running -= 1
+            now = time.monotonic()
+            while self._running < self.max_concurrent:
+                waiter = self._next_waiter()
+                if waiter is None:
+                    break
+                if self._expired(waiter, now):
+                    self._drop(waiter)
+                    waiter.event.set()
+                    continue
+                self._admit(waiter, now)
+                waiter.event.set()
+
+    def _expired(self, waiter: _Waiter, now: float) -> bool:
+        return waiter.deadline is not None and now >= waiter.deadline
+
+    def _admit(self, waiter: _Waiter, now: float) -> None:
+        waiter.admitted = True
+        self._running += 1
+        stats = self._stats[waiter.priority]
+        stats.admitted += 1
+        waited = now - waiter.enqueued
+        stats.wait_total += waited
+        stats.wait_max = max(stats.wait_max, waited)
+
+    def _drop(self, waiter: _Waiter) -> None:
+        waiter.dropped = True
+        self._stats[waiter.priority].dropped += 1
+
+    def _enqueue(self, waiter: _Waiter) -> None:
+        if waiter.priority == PRIORITY_INTERACTIVE:
+            self._interactive.append(waiter)
+        else:
+            self._batch.setdefault(waiter.job, deque()).append(waiter)
+
+    def _remove(self, waiter: _Waiter) -> None:
+        if waiter.priority == PRIORITY_INTERACTIVE:
+            self._interactive.remove(waiter)
+            return
+        waiting = self._batch[waiter.job]
+        waiting.remove(waiter)
+        if not waiting:
+            del self._batch[waiter.job]
+
+    def _next_waiter(self) -> Optional[_Waiter]:
+        # Interactive first, in arrival order
+        if self._interactive:
+            return self._interactive.popleft()
+        if not self._batch:
+            return None
+        # Batch: take one request from the first job and move that job to the back
+        job, waiting = next(iter(self._batch.items()))
+        waiter = waiting.popleft()
+        if waiting:
+            self._batch.move_to_end(job)
+        else:
+            del self._batch[job]
+        return waiter
+
+    def _queue_depth(self) -> int:
+        return len(self._interactive) + sum(len(waiting) for waiting in self._batch.values())
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        :return: calls in flight, queue depth per priority, and admitted/dropped counts and wait times (seconds) per
+                 priority
+        """
+        with self._lock:
+            result: Dict[str, Any] = {
+                'running': self._running,
+                'queue_depth': {
+                    PRIORITY_INTERACTIVE: len(self._interactive),
+                    PRIORITY_BATCH: sum(len(waiting) for waiting in self._batch.values()),
+                },
+                'batch_jobs_waiting': len(self._batch),
+            }
+            for priority, stats in self._stats.items():
+                result[priority] = {
+                    'admitted': stats.admitted,
+                    'dropped': stats.dropped,
+                    'wait_mean': stats.wait_total / stats.admitted if stats.admitted else 0.0,
+                    'wait_max': stats.wait_max,
+                }
+            return result
+
+
+class _Slot:
+    __slots__ = ('_scheduler', '_options', '_held')
+
+    def __init__(self, scheduler: RequestScheduler, options: RequestOptions):
+        self._scheduler = scheduler
+        self._options = options
+        self._held = None
+
+    def __enter__(self):
+        if _slot_held.get():
+            return self
+        self._scheduler._acquire(self._options)
+        self._held = _slot_held.set(True)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._held is not None:
+            _slot_held.reset(self._held)
+            self._held = None
+            self._scheduler._release()
+        return False
@@ -1,6 +1,7 @@
 from enum import Enum
 import platform
-from ctypes import c_char, c_int, c_long, c_ubyte
+import struct
+from ctypes import c_char, c_int, c_long, c_ubyte, sizeof
 from ctypes import Structure
 from ctypes.wintypes import DWORD, INT
 
@@ -23,6 +24,31 @@ class struct_tagTOKENBASICINFO(Structure):
 
 token_basic_info = struct_tagTOKENBASICINFO
 
+
+def struct_layout(structure, fields) -> struct.Struct:
+    """
+    Build a struct.Struct that unpacks the named char array fields of a packed ctypes Structure from raw bytes and
+    skips the others
+    """
+    layout = '='
+    for name, _ in structure._fields_:
+        size = getattr(structure, name).size
+        layout += f'{size}s' if name in fields else f'{size}x'
+    assert struct.calcsize(layout) == sizeof(structure)
+    return struct.Struct(layout)
+
+
+def c_string(raw: bytes) -> str:
+    """
+    Decode a NUL padded char array from the token service. All stauto32 strings are utf-8.
+    """
+    return raw.split(b'\0', 1)[0].decode('utf-8', 'replace')
+
+
+# Layouts for parsing an EnumToken array without going through ctypes attribute access
+token_basic_info_fields = struct_layout(token_basic_info, ('serial_number', 'username', 'deviceID', 'descriptor'))
+token_basic_info_columns = struct_layout(token_basic_info, ('serial_number', 'username'))
+
 # A struct to hold token error information
 class struct_tagTOKENERRORINFO(Structure):
     _pack_ = 1  # source:False
@@ -0,0 +1,82 @@
+"""
+Coalescing of concurrent identical calls
+The first caller for a key makes the call. Callers with the same key that arrive while it is in flight wait for its
+result instead of making their own call. Nothing is cached: once the call returns, the next caller starts a new one.
+
+Each caller keeps its own deadline. A waiting caller whose deadline passes gets DeadlineExceededError without
+affecting the call in flight. A leader dropped for its own deadline doesn't pass that error on: the waiting callers
+start over and one of them makes the call.
+"""
+import threading
+import time
+from concurrent.futures import Future, wait
+from typing import Any, Callable, Dict, Hashable, Optional
+from ._scheduler import DeadlineExceededError
+
+
+class _LeaderDropped(Exception):
+    """
+    Set on the shared future when the leader was dropped for its own deadline
+    """
+    pass
+
+
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._in_flight: Dict[Hashable, Future] = {}
+        self.calls: int = 0
+        self.coalesced: int = 0
+
+    def do(self, key: Hashable, func: Callable, *args, deadline: Optional[float] = None) -> Any:
+        """
+        Call func(*args), or wait for the in-flight call with the same key
+        :param deadline: time.monotonic() after which this caller stops waiting, or None
+        :return: the result of the call. Exceptions from the call are raised to every waiter.
+        :raises DeadlineExceededError: when the deadline passes while waiting for another caller's call
+        """
+        while True:
+            with self._lock:
+                future = self._in_flight.get(key)
+                if future is None:
+                    future = self._in_flight[key] = Future()
+                    self.calls += 1
+                    leader = True
+                else:
+                    self.coalesced += 1
+                    leader = False
+
+            if leader:
+                return self._lead(key, future, func, args)
+
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            # Wait with concurrent.futures.wait, not future.result(timeout): the leader's own errors may be
+            # TimeoutErrors (CallTimeoutError) and must reach the waiting callers as they are
+            if not wait((future,), timeout).done:
+                raise DeadlineExceededError("Deadline passed while waiting for an identical call in flight")
+            try:
+                return future.result()
+            except _LeaderDropped:
+                # Start over. The first caller back makes the call under its own deadline.
+                continue
+
+    def _lead(self, key: Hashable, future: Future, func: Callable, args: tuple) -> Any:
+        try:
+            result = func(*args)
+        except DeadlineExceededError:
+            # The leader's deadline is its own. Don't hand it to the waiting callers.
+            self._forget(key)
+            future.set_exception(_LeaderDropped())
+            raise
+        except BaseException as e:
+            self._forget(key)
+            future.set_exception(e)
+            raise
+        # Forget the key before publishing the result so later callers never see a finished call
+        self._forget(key)
+        future.set_result(result)
+        return result
+
+    def _forget(self, key: Hashable) -> None:
+        with self._lock:
+            del self._in_flight[key]
@@ -0,0 +1,79 @@
+"""
+On-disk snapshot of enumerated token metadata so a new SDProcess can skip re-enumerating an unchanged token store
+
+Layout (little endian, no padding):
+    header: magic b'PSDS', version (H), token count (I), default token index (i)
+    one byte per token: the index of its pin style in SDProcess.valid_pin_styles
+    utf-8 text: serial, username, deviceID and descriptor of each token, each terminated by NUL
+
+The strings come from C char arrays, so they never contain NUL. Keeping them in one NUL separated block means a
+snapshot is read with one decode and one split instead of per-field parsing.
+"""
+import os
+import struct
+from pathlib import Path
+from typing import List, NamedTuple, Optional, Sequence, Union
+
+SNAPSHOT_MAGIC: bytes = b'PSDS'
+SNAPSHOT_VERSION: int = 1
+
+_header = struct.Struct('<4sHIi')
+_FIELDS_PER_TOKEN: int = 4
+
+
+class SnapshotRecord(NamedTuple):
+    serial: str
+    username: str
+    device_id: str
+    descriptor: str
+    pin_style: int
+
+
+def write_snapshot(path: Union[str, Path], records: Sequence[SnapshotRecord], default_index: int) -> None:
+    """
+    Write the snapshot to a temporary file and move it into place, so readers never see a partial file
+    """
+    path = Path(path)
+    text = ''.join(
+        f'{record.serial}\0{record.username}\0{record.device_id}\0{record.descriptor}\0' for record in records
+    )
+    data = b''.join((
+        _header.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(records), default_index),
+        bytes(record.pin_style for record in records),
+        text.encode('utf-8'),
+    ))
+
+    temp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+    temp_path.write_bytes(data)
+    os.replace(temp_path, path)
+
+
+def read_snapshot(path: Union[str, Path], token_count: int, default_index: int) -> Optional[List[SnapshotRecord]]:
+    """
+    Read the snapshot if it matches the live token count and default token index
+    :return: the snapshot records, or None if the snapshot is missing, unreadable or stale
+    """
+    try:
+        data = Path(path).read_bytes()
+    except OSError:
+        return None
+
+    if len(data) < _header.size:
+        return None
+    magic, version, count, default = _header.unpack_from(data)
+    if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION or count != token_count or default != default_index:
+        return None
+
+    pin_styles = data[_header.size:_header.size + count]
+    try:
+        fields = data[_header.size + count:].decode('utf-8').split('\0')
+    except UnicodeDecodeError:
+        return None
+    # Every field is NUL terminated, so the split leaves one empty string at the end
+    if len(pin_styles) != count or len(fields) != count * _FIELDS_PER_TOKEN + 1:
+        return None
+
+    return [
+        SnapshotRecord(fields[offset], fields[offset + 1], fields[offset + 2], fields[offset + 3], pin_style)
+        for pin_style, offset in zip(pin_styles, range(0, count * _FIELDS_PER_TOKEN, _FIELDS_PER_TOKEN))
+    ]
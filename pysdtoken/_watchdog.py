@@ -0,0 +1,306 @@
+"""
+Call timeouts and a circuit breaker for the vendor DLL
+When the token service hangs, a DLL call blocks its thread forever. SDProcess can run its DLL calls on supervised
+worker threads instead: a call that runs longer than call_timeout is abandoned and its worker retired and replaced,
+and a circuit breaker fails fast after repeated failures until a probe call succeeds again.
+
+The call timeout runs from when a worker starts the call. A call that waits longer than call_timeout for a free
+worker is dropped with QueueTimeoutError. That means the workers are busy, not that the service is hung, so it does
+not count against the circuit breaker.
+"""
+from __future__ import annotations
+import contextvars
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future, wait
+from typing import Any, Callable, Dict, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+class ServiceUnavailableError(Exception):
+    """
+    The token service could not serve the call in time
+    """
+    pass
+
+
+class CallTimeoutError(ServiceUnavailableError, TimeoutError):
+    """
+    A DLL call did not finish within the call timeout
+    """
+    pass
+
+
+class QueueTimeoutError(CallTimeoutError):
+    """
+    No worker was free to start a DLL call within the call timeout. Not counted against the circuit breaker.
+    """
+    pass
+
+
+class CircuitOpenError(ServiceUnavailableError):
+    """
+    The circuit breaker is open, so the call was not attempted
+    """
+    pass
+
+
+class CircuitBreaker:
+    """
+    Trips open after failure_threshold consecutive failures. While open, calls fail fast. After reset_timeout seconds
+    one probe call is let through (half-open): success closes the circuit, failure opens it again.
+    :param failure_threshold: consecutive failures or timeouts that open the circuit
+    :param reset_timeout: seconds to stay open before probing
+    """
+    CLOSED: str = 'closed'
+    OPEN: str = 'open'
+    HALF_OPEN: str = 'half-open'
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        if failure_threshold < 1:
+            raise ValueError(f"Invalid failure threshold {failure_threshold}")
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._state: str = self.CLOSED
+        self._opened_at: float = 0.0
+        self._probing: bool = False
+        self.consecutive_failures: int = 0
+        self.failures: int = 0
+        self.rejected: int = 0
+        self.trips: int = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state()
+
+    def _current_state(self) -> str:
+        if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+            self._state = self.HALF_OPEN
+        return self._state
+
+    def before_call(self) -> None:
+        """
+        Raise CircuitOpenError unless the call may go ahead
+        """
+        with self._lock:
+            state = self._current_state()
+            if state == self.CLOSED:
+                return
+            if state == self.HALF_OPEN and not self._probing:
+                logger.info("Circuit half-open. Letting one probe call through.")
+                self._probing = True
+                return
+            self.rejected += 1
+        raise CircuitOpenError(f"Token service circuit is {state}")
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self._state != self.CLOSED:
+                logger.warning("Token service recovered. Closing circuit.")
+            self._state = self.CLOSED
+            self._probing = False
+            self.consecutive_failures = 0
+
+    def record_skipped(self) -> None:
+        """
+        A call that says nothing about the service's health. It neither closes nor opens the circuit, but frees the
+        probe slot if it was the half-open probe.
+        """
+        with self._lock:
+            self._probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            self.consecutive_failures += 1
+            if self._state == self.HALF_OPEN or (
+                    self._state == self.CLOSED and self.consecutive_failures >= self.failure_threshold):
+                logger.error(f"Opening token service circuit after {self.consecutive_failures} consecutive failures")
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+                self.trips += 1
+            self._probing = False
+
+
+class DLLWatchdog:
+    """
+    Runs DLL calls on supervised worker threads with a timeout and a circuit breaker
+    :param call_timeout: seconds a DLL call may run, and seconds a call may wait for a free worker
+    :param failure_threshold: consecutive failures or timeouts that open the circuit
+    :param reset_timeout: seconds the circuit stays open before probing
+    :param workers: number of worker threads making DLL calls
+    """
+
+    def __init__(self, call_timeout: float, failure_threshold: int = 5, reset_timeout: float = 30.0,
+                 workers: int = 1):
+        if call_timeout <= 0:
+            raise ValueError(f"Invalid call timeout {call_timeout}")
+        if workers < 1:
+            raise ValueError(f"Invalid worker count {workers}")
+        self.workers = workers
+        self.call_timeout = call_timeout
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        # future -> (retire event of the worker running it, time.monotonic() when the worker picked it up)
+        self._running: Dict[Future, Tuple[threading.Event, float]] = {}
+        self._spawned: int = 0
+        self._shut_down: bool = False
+        # Set on a worker while it runs a call
+        self._local = threading.local()
+        self.calls: int = 0
+        self.timeouts: int = 0
+        self.queue_timeouts: int = 0
+        self.abandoned_workers: int = 0
+        for _ in range(workers):
+            self._spawn_worker()
+
+    def _spawn_worker(self) -> None:
+        retired = threading.Event()
+        self._spawned += 1
+        # Daemon threads: a worker stuck in a hung DLL call must not keep the interpreter alive
+        worker = threading.Thread(target=self._work, args=(retired,), name=f'pysdtoken-dll-{self._spawned}',
+                                  daemon=True)
+        worker.start()
+
+    def _work(self, retired: threading.Event) -> None:
+        while not retired.is_set():
+            item = self._queue.get()
+            if item is None:
+                # Sentinel from shutdown()
+                return
+            future, context, func, args = item
+            # Register before running so a caller whose call is no longer cancellable always finds its start time
+            with self._lock:
+                self._running[future] = (retired, time.monotonic())
+            if not future.set_running_or_notify_cancel():
+                with self._lock:
+                    self._running.pop(future, None)
+                continue
+            self._local.in_call = True
+            try:
+                result = context.run(func, *args)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+            finally:
+                self._local.in_call = False
+                with self._lock:
+                    self._running.pop(future, None)
+        logger.info(f"Retired DLL worker {threading.current_thread().name} finished its hung call")
+
+    def call(self, func: Callable, args: Sequence[Any], name: str = '',
+             succeeded: Optional[Callable[[Any], Optional[bool]]] = None) -> Any:
+        """
+        Run func(*args) on a worker. Wait at most call_timeout for a worker to start it and at most call_timeout for
+        it to run.
+        :param name: the export name for error messages
+        :param succeeded: judges what func returned. False counts as a failure and None leaves the breaker alone.
+            Without it every call that returns counts as a success.
+        :return: what func returned
+        :raises QueueTimeoutError: when no worker started the call in time
+        :raises CallTimeoutError: when the call ran longer than call_timeout
+        """
+        if getattr(self._local, 'in_call', False):
+            # Made from inside a call (e.g. by a trace hook). Queueing it would wait on this same worker, so run it
+            # here under the outer call's timeout.
+            return func(*args)
+        if self._shut_down:
+            raise ServiceUnavailableError("The DLL watchdog is shut down")
+        self.breaker.before_call()
+        future: Future = Future()
+        self.calls += 1
+        label = name or getattr(func, '__name__', func)
+        # Run in the caller's context so tracing spans propagate to the worker
+        self._queue.put((future, contextvars.copy_context(), func, args))
+        wait_until = time.monotonic() + self.call_timeout
+        # concurrent.futures.wait, not future.result(timeout): the call itself may raise a TimeoutError
+        while not wait((future,), max(0.0, wait_until - time.monotonic())).done:
+            with self._lock:
+                running = self._running.get(future)
+            if running is None:
+                if future.cancel():
+                    # Still queued behind other calls. The service isn't hung, the workers are busy.
+                    self.queue_timeouts += 1
+                    self.breaker.record_skipped()
+                    raise QueueTimeoutError(f"No DLL worker was free to start {label} within {self.call_timeout} "
+                                            f"seconds")
+                # A worker picked it up (or finished it) just now
+                continue
+            wait_until = running[1] + self.call_timeout
+            if time.monotonic() < wait_until:
+                # Started late. Give it its full call_timeout from when it started.
+                continue
+            if self._abandon(future):
+                self.timeouts += 1
+                self.breaker.record_failure()
+                raise CallTimeoutError(f"{label} did not finish within {self.call_timeout} seconds")
+
+        try:
+            result = future.result()
+        except BaseException:
+            self.breaker.record_failure()
+            raise
+        verdict = succeeded(result) if succeeded is not None else True
+        if verdict is None:
+            self.breaker.record_skipped()
+        elif verdict:
+            self.breaker.record_success()
+        else:
+            self.breaker.record_failure()
+        return result
+
+    def _abandon(self, future: Future) -> bool:
+        """
+        Retire the worker stuck in future's call and start a new one
+        :return: False if the call finished in the meantime
+        """
+        with self._lock:
+            running = self._running.pop(future, None)
+            if running is None:
+                return False
+            running[0].set()
+            self.abandoned_workers += 1
+            if self._shut_down:
+                return True
+        logger.error("DLL call hung. Retiring its worker and starting a new one.")
+        self._spawn_worker()
+        return True
+
+    def shutdown(self) -> None:
+        """
+        Stop the workers once they have run the calls already queued. A worker stuck in a hung call exits when the
+        call returns. Calls made after shutdown raise ServiceUnavailableError.
+        """
+        with self._lock:
+            if self._shut_down:
+                return
+            self._shut_down = True
+            # Retired workers exit on their own, so only the live ones need a sentinel
+            live = self._spawned - self.abandoned_workers
+        for _ in range(live):
+            self._queue.put(None)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        :return: breaker state and call counters for monitoring
+        """
+        return {
+            'state': self.breaker.state,
+            'consecutive_failures': self.breaker.consecutive_failures,
+            'calls': self.calls,
+            'failures': self.breaker.failures,
+            'timeouts': self.timeouts,
+            'queue_timeouts': self.queue_timeouts,
+            'rejected': self.breaker.rejected,
+            'trips': self.breaker.trips,
+            'abandoned_workers': self.abandoned_workers,
+            'workers': self.workers,
+        }
@@ -0,0 +1,285 @@
+"""
+Shared-memory code board for processes on the same host
+One process runs a CodeBoardPublisher on top of its SDProcess. It writes each token's current tokencode, time left
+and window deadline into a fixed-layout multiprocessing.shared_memory segment and rewrites them at every rollover.
+Any other process reads them with CodeBoardReader: no DLL load, no token service handle and no IPC round trip.
+
+Each slot is guarded by a seqlock-style version counter. The publisher makes the counter odd while it writes a slot
+and even again when it is done. A reader retries while the counter is odd or changed during its read, so reads
+never block the publisher and never see a half-written slot.
+
+Layout (little endian):
+    header: magic b'PSDB', version (H), 2 pad bytes, slot count (I), slot size (I)
+    slots:  version counter (Q), serial (24s), tokencode (16s), deadline as time.time() seconds (d),
+            published as time.time() seconds (d)
+
+    # publisher
+    board = sd.start_code_board('pysdtoken-codes')
+
+    # any other process
+    reader = CodeBoardReader('pysdtoken-codes')
+    reader.read('000123456789')
+"""
+from __future__ import annotations
+import logging
+import math
+import struct
+import threading
+import time
+from multiprocessing import shared_memory
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Set
+from ._sdauto import token_basic_info, c_string
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+BOARD_MAGIC: bytes = b'PSDB'
+BOARD_VERSION: int = 1
+
+_header = struct.Struct('<4sH2xII')
+_version = struct.Struct('<Q')
+_payload = struct.Struct(f'<{token_basic_info.serial_number.size}s16sdd')
+# Slots start on 8 byte boundaries so the version counter is written in one aligned store
+_SLOT_SIZE: int = (_version.size + _payload.size + 7) // 8 * 8
+_SLOTS_OFFSET: int = (_header.size + 7) // 8 * 8
+# A reader gives up if a slot stays mid-write for this many seconds (the publisher died while writing it)
+_READ_TIMEOUT: float = 1.0
+# Boards published by this process. Their resource tracker registration belongs to the publisher.
+_published: Set[str] = set()
+
+
+class CodeBoardEntry(NamedTuple):
+    """
+    A token's published code
+    :param serial: the token serial
+    :param tokencode: the tokencode for the window that ends at deadline ('' if not published yet)
+    :param time_left: seconds until deadline, rounded up. 0 means the code has expired and was not rolled over.
+    :param deadline: time.time() by which the window ends. The DLL reports whole seconds, so this is the latest the
+        window can end and the board can keep the previous code for up to a second after the rollover.
+    :param published: time.time() when the code was written
+    """
+    serial: str
+    tokencode: str
+    time_left: int
+    deadline: float
+    published: float
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    """
+    Attach to an existing segment without letting this process's resource tracker unlink it at exit
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13 registers attached segments with the resource tracker, which unlinks them when the reader
+        # exits and pulls the board out from under the publisher
+        segment = shared_memory.SharedMemory(name=name)
+        if segment.name in _published:
+            return segment
+        try:
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(segment._name, 'shared_memory')
+        except Exception as e:
+            logger.debug(e)
+        return segment
+
+
+class CodeBoardPublisher:
+    """
+    Publishes the current tokencodes of an SDProcess's tokens to shared memory
+    :param token_service: the SDProcess to get codes from
+    :param name: the shared memory segment name. None lets the OS pick one (see .name).
+    :param serials: the serials to publish. Defaults to all of the SDProcess tokens.
+    """
+
+    def __init__(self, token_service: Any, name: Optional[str] = None, serials: Optional[Sequence[str]] = None):
+        self.process = token_service
+        self.serials: List[str] = list(serials) if serials is not None else [
+            token.serial_number for token in token_service.tokens
+        ]
+        self._segment = shared_memory.SharedMemory(
+            name=name, create=True, size=max(1, _SLOTS_OFFSET + _SLOT_SIZE * len(self.serials))
+        )
+        self.name: str = self._segment.name
+        _published.add(self.name)
+        self._buffer: memoryview = self._segment.buf
+        self._versions: List[int] = [0] * len(self.serials)
+        # The seqlock allows one writer. publish() may be called from the background thread and directly.
+        self._write_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        # Serials never change after the board is created, so readers index them once
+        for slot, serial in enumerate(self.serials):
+            self._write_slot(slot, serial, '', 0.0, 0.0)
+        _header.pack_into(self._buffer, 0, BOARD_MAGIC, BOARD_VERSION, len(self.serials), _SLOT_SIZE)
+        logger.info(f"Created code board {self.name} for {len(self.serials)} tokens")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def _write_slot(self, slot: int, serial: str, tokencode: str, deadline: float, published: float) -> None:
+        offset = _SLOTS_OFFSET + slot * _SLOT_SIZE
+        version = self._versions[slot]
+        _version.pack_into(self._buffer, offset, version + 1)
+        _payload.pack_into(
+            self._buffer, offset + _version.size,
+            serial.encode('utf-8'), tokencode.encode('utf-8'), deadline, published
+        )
+        _version.pack_into(self._buffer, offset, version + 2)
+        self._versions[slot] = version + 2
+
+    def publish(self) -> float:
+        """
+        Get the current code of every token and write it to the board
+        :return: the earliest deadline written, time.time() seconds
+        """
+        with self._write_lock:
+            return self._publish()
+
+    def _publish(self) -> float:
+        earliest: float = float('inf')
+        for slot, serial in enumerate(self.serials):
+            token = self.process.get_token_by_serial(serial)
+            pin_style = token.pin_style if token else self.process.valid_pin_styles[0]
+            try:
+                _, tokencode, time_left = self.process.get_token_current_code(serial, pin_style)
+            except Exception as e:
+                logger.debug(e)
+                logger.error(f"Could not get the current code of {serial} for the code board")
+                continue
+            if not tokencode:
+                continue
+            now = time.time()
+            # time_left is whole seconds rounded down, so the window ends within a second after now + time_left.
+            # Taking the latest end keeps a still-valid code on the board and wakes the publisher after the rollover.
+            deadline = now + time_left + 1
+            self._write_slot(slot, serial, tokencode, deadline, now)
+            earliest = min(earliest, deadline)
+        return earliest
+
+    def start(self) -> CodeBoardPublisher:
+        """
+        Publish now and then again at every rollover on a background thread
+        :return: self
+        """
+        if self._thread and self._thread.is_alive():
+            return self
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name=f'pysdtoken-codeboard-{self.name}', daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            earliest = self.publish()
+            if earliest == float('inf'):
+                # Nothing could be published. Try again shortly.
+                wait = 1.0
+            else:
+                # Wake just after the earliest window ends so the next code is current
+                wait = max(0.05, earliest - time.time() + 0.05)
+            self._stop.wait(wait)
+
+    def stop(self) -> None:
+        """
+        Stop the background publisher. The board keeps its last codes.
+        """
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def close(self) -> None:
+        """
+        Stop publishing and remove the shared memory segment
+        """
+        self.stop()
+        self._buffer.release()
+        self._segment.close()
+        try:
+            self._segment.unlink()
+        except FileNotFoundError:
+            pass
+        _published.discard(self.name)
+        logger.info(f"Removed code board {self.name}")
+
+
+class CodeBoardReader:
+    """
+    Reads tokencodes from a board published by CodeBoardPublisher, lock free and without loading the DLL
+    :param name: the shared memory segment name the publisher was created with
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._segment = _attach(name)
+        self._buffer: memoryview = self._segment.buf
+        magic, version, count, slot_size = _header.unpack_from(self._buffer, 0)
+        if magic != BOARD_MAGIC or version != BOARD_VERSION or slot_size != _SLOT_SIZE:
+            self.close()
+            raise ValueError(f"{name} is not a pysdtoken code board this version can read")
+        # serial -> slot offset
+        self._offsets: Dict[str, int] = {}
+        for slot in range(count):
+            offset = _SLOTS_OFFSET + slot * _SLOT_SIZE
+            self._offsets[self._read_slot(offset).serial] = offset
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    @property
+    def serials(self) -> List[str]:
+        return list(self._offsets)
+
+    def _read_slot(self, offset: int) -> CodeBoardEntry:
+        buffer = self._buffer
+        give_up: Optional[float] = None
+        while True:
+            before, = _version.unpack_from(buffer, offset)
+            # An odd version means the publisher is writing this slot
+            if not before & 1:
+                serial, tokencode, deadline, published = _payload.unpack_from(buffer, offset + _version.size)
+                after, = _version.unpack_from(buffer, offset)
+                if before == after:
+                    return CodeBoardEntry(
+                        c_string(serial),
+                        c_string(tokencode),
+                        max(0, math.ceil(deadline - time.time())),
+                        deadline,
+                        published,
+                    )
+            # The publisher can be descheduled mid-write. Yield so it can finish instead of spinning.
+            if give_up is None:
+                give_up = time.monotonic() + _READ_TIMEOUT
+            elif time.monotonic() > give_up:
+                raise RuntimeError(f"Code board {self.name} slot stayed mid-write for {_READ_TIMEOUT} seconds")
+            time.sleep(0)
+
+    def read(self, serial: str) -> Optional[CodeBoardEntry]:
+        """
+        :return: the published code for serial, or None if the board has no such token
+        """
+        offset = self._offsets.get(serial)
+        if offset is None:
+            return None
+        return self._read_slot(offset)
+
+    def read_all(self) -> List[CodeBoardEntry]:
+        return [self._read_slot(offset) for offset in self._offsets.values()]
+
+    def close(self) -> None:
+        """
+        Detach from the board. The publisher owns the segment.
+        """
+        self._buffer.release()
+        self._segment.close()
@@ -0,0 +1,561 @@
+"""
+Load test harness for pysdtoken
+Drives SDProcess with many concurrent requesters (threads, processes or asyncio tasks) against a stand-in token
+service with injected latency and error rates. Each step reports throughput, latency percentiles, error counts and
+the time_left distribution, and the number of workers is increased step by step to find the saturation point.
+
+    python -m pysdtoken.loadtest --mode thread --steps 1,2,4,8,16 --duration 5 --latency-ms 2 --error-rate 0.01
+"""
+from __future__ import annotations
+import argparse
+import asyncio
+import logging
+import math
+import multiprocessing
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+import tracemalloc
+import zlib
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from ctypes import memmove, sizeof
+from typing import List, Dict, NamedTuple, Tuple, Any, Optional, Sequence
+from ._sdauto import token_basic_info, TokenError
+from .pysdtoken import SDProcess
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+def _deref(arg: Any) -> Any:
+    """
+    Return the ctypes object behind a byref() argument, or the argument itself
+    """
+    return getattr(arg, '_obj', arg)
+
+
+class _Export:
+    """
+    A callable that looks enough like a ctypes function pointer for SDProcess to configure (restype, argtypes) and
+    call it. Counts its calls so the harness can report how many times the backend was hit.
+    :param name: the stauto32 export name
+    :param func: the python implementation of the export
+    """
+
+    def __init__(self, name: str, func: Any):
+        self.__name__ = name
+        self.restype: Any = None
+        self.argtypes: Any = None
+        self._func = func
+        self._lock = threading.Lock()
+        self.calls: int = 0
+
+    def __call__(self, *args):
+        with self._lock:
+            self.calls += 1
+        return self._func(*args)
+
+
+class StandInBackend:
+    """
+    A stand-in for stauto32 that implements the exports SDProcess uses. Tokencodes are derived from the serial and
+    the current 60 second window so they roll over like a real token.
+    :param token_count: number of tokens to register
+    :param latency: seconds to sleep in every export call
+    :param jitter: +/- seconds of uniform random jitter on the latency
+    :param error_rate: probability (0-1) that a code or date call fails
+    :param seed: seed for the latency/error random generator
+    """
+    # Export names and the methods that implement them
+    exports: Dict[str, str] = {
+        'OpenTokenService': '_open_token_service',
+        'CloseTokenService': '_close_token_service',
+        'EnumToken': '_enum_token',
+        'GetCurrentCode': '_get_current_code',
+        'GetNextCode': '_get_next_code',
+        'CanTokenGetNextCode': '_can_token_get_next_code',
+        'GetTokenExpirationDate': '_get_token_expiration_date',
+        'GetTokenError': '_get_token_error',
+        'ImportToken': '_import_token',
+    }
+    window: int = 60
+
+    def __init__(self, token_count: int = 10, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0,
+                 seed: Optional[int] = None):
+        self.name: str = f'stand-in({token_count} tokens)'
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._last_error: int = 0
+        self.default_index: int = 0
+        self.serials: List[str] = [f'{index + 100000000000:012d}' for index in range(token_count)]
+        # Spread the RSA pin styles over the tokens so requests exercise all three
+        self.pin_styles: Dict[str, str] = {
+            serial: SDProcess.valid_pin_styles[index % len(SDProcess.valid_pin_styles)]
+            for index, serial in enumerate(self.serials)
+        }
+
+        self._records: bytes = self._build_records()
+        self._lock = threading.Lock()
+
+        for export, method in self.exports.items():
+            setattr(self, export, _Export(export, getattr(self, method)))
+
+    def __repr__(self):
+        return self.name
+
+    def call_counts(self) -> Dict[str, int]:
+        """
+        :return: the number of calls made to each export
+        """
+        return {export: getattr(self, export).calls for export in self.exports}
+
+    def _build_records(self) -> bytes:
+        # Build the TOKENBASICINFO array once. EnumToken copies it into the caller's buffer.
+        records: Any = (token_basic_info * len(self.serials))()
+        for record, serial in zip(records, self.serials):
+            record.dwSize = sizeof(token_basic_info)
+            record.serial_number = serial.encode('utf-8')
+            record.username = f'user{serial[-6:]}'.encode('utf-8')
+            record.descriptor = self.pin_styles[serial].encode('utf-8')
+        return bytes(records)
+
+    def _delay(self) -> None:
+        if self.latency or self.jitter:
+            time.sleep(max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter)))
+
+    def _failed(self) -> bool:
+        if self.error_rate and self._random.random() < self.error_rate:
+            self._last_error = TokenError.ERROR_TOKENCODE_GENERATION.value
+            return True
+        return False
+
+    def _tokencode(self, serial: str, window: int, length: int) -> str:
+        return f'{zlib.crc32(f"{serial}:{window}".encode("utf-8")):010d}'[-length:]
+
+    def _passcode(self, serial: str, pin: str, tokencode: str) -> str:
+        pin_style = self.pin_styles.get(serial, SDProcess.valid_pin_styles[0])
+        if pin_style == 'Fob-style':
+            return pin + tokencode
+        if pin_style == 'PINPad-style' and pin.isdigit():
+            # Roll the pin into the tail of the tokencode digit by digit
+            head = tokencode[:-len(pin)] if len(pin) < len(tokencode) else ''
+            tail = tokencode[len(head):]
+            return head + ''.join(str((int(t) + int(p)) % 10) for t, p in zip(tail, pin[-len(tail):]))
+        return tokencode
+
+    def _write_code(self, serial_arg: bytes, pin_arg: Any, time_left_arg: Any, passcode_arg: Any, prn_arg: Any,
+                    offset: int) -> int:
+        self._delay()
+        serial = bytes(serial_arg).decode('utf-8')
+        if serial not in self.pin_styles:
+            self._last_error = TokenError.ERROR_TOKEN_NOTFOUND.value
+            return 0
+        if self._failed():
+            return 0
+
+        now = time.time()
+        window = int(now // self.window) + offset
+        pin = (_deref(pin_arg).value or b'').decode('utf-8')
+        tokencode = self._tokencode(serial, window, len(prn_arg))
+        passcode = self._passcode(serial, pin, tokencode)
+        prn_arg.value = tokencode.encode('utf-8')
+        passcode_arg.value = passcode.encode('utf-8')[:len(passcode_arg)]
+        _deref(time_left_arg).value = int(self.window - now % self.window) + offset * self.window
+        return 1
+
+    def _open_token_service(self, handle: Any) -> int:
+        self._delay()
+        _deref(handle).value = 1
+        return 1
+
+    def _close_token_service(self, handle: Any) -> int:
+        return 1
+
+    def _enum_token(self, handle: Any, token_count: Any, default_token: Any, buffer: Any, buffer_size: Any) -> int:
+        self._delay()
+        _deref(token_count).value = len(self.serials)
+        _deref(default_token).value = self.default_index
+        _deref(buffer_size).value = len(self._records)
+        if not buffer:
+            # Sizing call
+            return 1
+        array = _deref(buffer)
+        memmove(array, self._records, min(sizeof(array), len(self._records)))
+        return 1
+
+    def _get_current_code(self, handle, serial, pin, time_left, passcode, prn) -> int:
+        return self._write_code(serial, pin, time_left, passcode, prn, 0)
+
+    def _get_next_code(self, handle, serial, pin, time_left, passcode, prn) -> int:
+        return self._write_code(serial, pin, time_left, passcode, prn, 1)
+
+    def _can_token_get_next_code(self, handle: Any, serial: bytes, can_it: Any) -> int:
+        self._delay()
+        can_it.contents.value = 1
+        return 1
+
+    def _get_token_expiration_date(self, handle: Any, serial: bytes, expiration_date: Any) -> int:
+        self._delay()
+        if self._failed():
+            return 0
+        expiration_date.year[:] = b'2035'
+        expiration_date.month[:] = b'12'
+        expiration_date.day[:] = b'31'
+        return 1
+
+    def _import_token(self, handle: Any, data: bytes, password: Optional[bytes]) -> int:
+        self._delay()
+        match = re.search(rb'<SN>\s*(\d+)\s*</SN>', data or b'')
+        if not match:
+            self._last_error = TokenError.ERROR_FILE_FORMAT.value
+            return 0
+        serial = match.group(1).decode('utf-8')
+        with self._lock:
+            if serial in self.pin_styles:
+                self._last_error = TokenError.ERROR_DUPLICATE_SERIAL.value
+                return 0
+            self.serials.append(serial)
+            self.pin_styles[serial] = SDProcess.valid_pin_styles[0]
+            self._records = self._build_records()
+        return 1
+
+    def _get_token_error(self, handle: Any, token_error: Any) -> int:
+        token_error.contents.error = self._last_error
+        return 1
+
+
+class LoadConfig(NamedTuple):
+    """
+    Everything a worker needs to build its own SDProcess and stand-in backend (processes can't share ctypes objects)
+    """
+    mode: str = 'thread'
+    token_count: int = 50
+    pins: Tuple[str, ...] = ('', '1234', '98765432')
+    latency: float = 0.0
+    jitter: float = 0.0
+    error_rate: float = 0.0
+    duration: float = 2.0
+    seed: int = 0
+
+
+class StepResult(NamedTuple):
+    workers: int
+    requests: int
+    errors: int
+    duration: float
+    throughput: float
+    p50: float
+    p95: float
+    p99: float
+    max: float
+    time_left: Counter
+    backend_calls: int
+
+
+def build_process(config: LoadConfig) -> Tuple[SDProcess, StandInBackend]:
+    """
+    Build an SDProcess on top of a fresh stand-in backend and give its tokens the backend's pin styles
+    :param config: the load test configuration
+    :return: the SDProcess and the backend it drives
+    """
+    backend = StandInBackend(config.token_count, config.latency, config.jitter, config.error_rate, config.seed)
+    sd = SDProcess(log_level='CRITICAL', backend=backend)
+    for token in sd.tokens:
+        token.set_pin_style(backend.pin_styles[token.serial_number])
+    return sd, backend
+
+
+def _request(sd: SDProcess, rng: random.Random, pins: Sequence[str]) -> Tuple[float, int, bool]:
+    """
+    Ask a random token for its current code with a random pin
+    :return: latency in seconds, time left and whether it succeeded
+    """
+    token = rng.choice(sd.tokens)
+    pin = rng.choice(pins)
+    start = time.perf_counter()
+    try:
+        info = token.get_current_code(pin)
+    except Exception as e:
+        logger.debug(e)
+        return time.perf_counter() - start, 0, False
+    return time.perf_counter() - start, info.time_left, bool(info.tokencode)
+
+
+def _run_loop(sd: SDProcess, config: LoadConfig, seed: int, stop_at: float) -> Tuple[List[float], List[int], int]:
+    rng = random.Random(seed)
+    latencies: List[float] = []
+    time_left: List[int] = []
+    errors = 0
+    while time.perf_counter() < stop_at:
+        latency, left, ok = _request(sd, rng, config.pins)
+        latencies.append(latency)
+        if ok:
+            time_left.append(left)
+        else:
+            errors += 1
+    return latencies, time_left, errors
+
+
+def _process_worker(args: Tuple[LoadConfig, int]) -> Tuple[List[float], List[int], int, int]:
+    config, seed = args
+    sd, backend = build_process(config)
+    calls_before = sum(backend.call_counts().values())
+    latencies, time_left, errors = _run_loop(sd, config, seed, time.perf_counter() + config.duration)
+    return latencies, time_left, errors, sum(backend.call_counts().values()) - calls_before
+
+
+async def _async_worker(sd: SDProcess, config: LoadConfig, seed: int, stop_at: float, executor: ThreadPoolExecutor):
+    # DLL calls block, so tasks hand them to an executor the way an asyncio service would
+    loop = asyncio.get_event_loop()
+    rng = random.Random(seed)
+    latencies: List[float] = []
+    time_left: List[int] = []
+    errors = 0
+    while time.perf_counter() < stop_at:
+        latency, left, ok = await loop.run_in_executor(executor, _request, sd, rng, config.pins)
+        latencies.append(latency)
+        if ok:
+            time_left.append(left)
+        else:
+            errors += 1
+    return latencies, time_left, errors
+
+
+async def _run_async(sd: SDProcess, config: LoadConfig, workers: int, stop_at: float):
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return await asyncio.gather(
+            *(_async_worker(sd, config, config.seed + n, stop_at, executor) for n in range(workers))
+        )
+
+
+def percentile(ordered: Sequence[float], fraction: float) -> float:
+    """
+    Nearest-rank percentile of an already sorted sequence
+    """
+    if not ordered:
+        return 0.0
+    rank = max(0, min(len(ordered) - 1, math.ceil(fraction * len(ordered)) - 1))
+    return ordered[rank]
+
+
+def run_step(config: LoadConfig, workers: int) -> StepResult:
+    """
+    Run one load step with the given number of concurrent workers
+    :param config: the load test configuration
+    :param workers: number of threads, processes or asyncio tasks
+    :return: StepResult
+    """
+    results: List[Tuple[List[float], List[int], int]] = []
+    backend_calls = 0
+    start = time.perf_counter()
+
+    if config.mode == 'process':
+        with multiprocessing.Pool(workers) as pool:
+            for latencies, time_left, errors, calls in pool.map(
+                    _process_worker, [(config, config.seed + n) for n in range(workers)]):
+                results.append((latencies, time_left, errors))
+                backend_calls += calls
+        # Every process measures its own duration window
+        duration = config.duration
+    else:
+        sd, backend = build_process(config)
+        calls_before = sum(backend.call_counts().values())
+        start = time.perf_counter()
+        stop_at = start + config.duration
+        if config.mode == 'asyncio':
+            results = asyncio.run(_run_async(sd, config, workers, stop_at))
+        else:
+            threads: List[threading.Thread] = []
+            for n in range(workers):
+                def target(n=n):
+                    results.append(_run_loop(sd, config, config.seed + n, stop_at))
+                threads.append(threading.Thread(target=target, name=f'loadtest-{n}'))
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        duration = time.perf_counter() - start
+        backend_calls = sum(backend.call_counts().values()) - calls_before
+
+    latencies = sorted(latency for result in results for latency in result[0])
+    time_left = Counter((left // 10) * 10 for result in results for left in result[1])
+    errors = sum(result[2] for result in results)
+    return StepResult(
+        workers=workers,
+        requests=len(latencies),
+        errors=errors,
+        duration=duration,
+        throughput=len(latencies) / duration if duration else 0.0,
+        p50=percentile(latencies, 0.50),
+        p95=percentile(latencies, 0.95),
+        p99=percentile(latencies, 0.99),
+        max=latencies[-1] if latencies else 0.0,
+        time_left=time_left,
+        backend_calls=backend_calls,
+    )
+
+
+def run(config: LoadConfig, steps: Sequence[int], saturation_gain: float = 0.05, stop_at_saturation: bool = True):
+    """
+    Scale the number of workers step by step. Saturation is the last step that improved throughput by more than
+    saturation_gain over the best step before it.
+    :return: a generator of StepResult. The generator's return value is the saturating StepResult.
+    """
+    best: Optional[StepResult] = None
+    for workers in steps:
+        result = run_step(config, workers)
+        yield result
+        if best is None or result.throughput > best.throughput * (1 + saturation_gain):
+            best = result
+        elif stop_at_saturation:
+            break
+    return best
+
+
+def benchmark_enumeration(token_count: int, latency: float = 0.0, repeat: int = 5) -> Dict[str, float]:
+    """
+    Time token enumeration against a stand-in backend with token_count tokens
+    :param token_count: number of registered tokens
+    :param latency: seconds of injected latency per DLL call
+    :param repeat: runs per measurement. The best run is reported.
+    :return: milliseconds for construction (with and without a warm snapshot), refresh_tokens and
+             get_token_columns, and the peak KiB allocated while constructing an SDProcess
+    """
+    backend = StandInBackend(token_count, latency=latency)
+    snapshot_path = os.path.join(tempfile.mkdtemp(prefix='pysdtoken-'), 'tokens.snapshot')
+    SDProcess(log_level='CRITICAL', backend=backend, snapshot_path=snapshot_path)
+    timings: Dict[str, float] = {}
+    for name, func in (
+            ('construct_ms', lambda: SDProcess(log_level='CRITICAL', backend=backend)),
+            ('construct_snapshot_ms',
+             lambda: SDProcess(log_level='CRITICAL', backend=backend, snapshot_path=snapshot_path)),
+            ('refresh_tokens_ms', SDProcess(log_level='CRITICAL', backend=backend).refresh_tokens),
+            ('get_token_columns_ms', SDProcess(log_level='CRITICAL', backend=backend).get_token_columns),
+    ):
+        best = float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            best = min(best, time.perf_counter() - start)
+        timings[name] = best * 1000
+    os.remove(snapshot_path)
+    os.rmdir(os.path.dirname(snapshot_path))
+
+    tracemalloc.start()
+    SDProcess(log_level='CRITICAL', backend=backend)
+    timings['construct_peak_kib'] = tracemalloc.get_traced_memory()[1] / 1024
+    tracemalloc.stop()
+    return timings
+
+
+def benchmark_herd(threads: int, latency: float = 0.001, rounds: int = 5) -> Dict[str, int]:
+    """
+    Release threads all at once to ask the same token for its current code, the way they pile up at the start of a
+    token window
+    :param threads: number of concurrent requesters
+    :param latency: seconds of injected latency per DLL call
+    :param rounds: number of times the herd is released
+    :return: number of requests, GetCurrentCode calls made to the backend, and requests that got no code
+    """
+    backend = StandInBackend(1, latency=latency)
+    sd = SDProcess(log_level='CRITICAL', backend=backend)
+    token = sd.tokens[0]
+    calls_before = backend.GetCurrentCode.calls
+    barrier = threading.Barrier(threads)
+    errors: List[int] = []
+
+    def requester():
+        for _ in range(rounds):
+            barrier.wait()
+            if not token.get_current_code().tokencode:
+                errors.append(1)
+
+    herd = [threading.Thread(target=requester, name=f'herd-{n}') for n in range(threads)]
+    for thread in herd:
+        thread.start()
+    for thread in herd:
+        thread.join()
+    return {
+        'requests': threads * rounds,
+        'dll_calls': backend.GetCurrentCode.calls - calls_before,
+        'errors': len(errors),
+    }
+
+
+def format_step(result: StepResult) -> str:
+    time_left = ' '.join(f'{bucket}s:{count}' for bucket, count in sorted(result.time_left.items()))
+    return (
+        f"{result.workers:>7} {result.requests:>9} {result.errors:>7} {result.throughput:>10.1f} "
+        f"{result.p50 * 1000:>8.2f} {result.p95 * 1000:>8.2f} {result.p99 * 1000:>8.2f} {result.max * 1000:>8.2f} "
+        f"{result.backend_calls:>9}  {time_left}"
+    )
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    parser = argparse.ArgumentParser(prog='python -m pysdtoken.loadtest', description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--mode', choices=('thread', 'process', 'asyncio'), default='thread')
+    parser.add_argument('--steps', default='1,2,4,8,16,32', help='comma separated worker counts')
+    parser.add_argument('--duration', type=float, default=2.0, help='seconds per step')
+    parser.add_argument('--tokens', type=int, default=50, help='number of stand-in tokens')
+    parser.add_argument('--pins', default=',1234,98765432', help='comma separated pins (empty for no pin)')
+    parser.add_argument('--latency-ms', type=float, default=1.0, help='injected latency per DLL call')
+    parser.add_argument('--jitter-ms', type=float, default=0.5, help='+/- uniform jitter on the latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='probability of a failed code call')
+    parser.add_argument('--saturation-gain', type=float, default=0.05,
+                        help='minimum throughput gain for a step to count as an improvement')
+    parser.add_argument('--all-steps', action='store_true', help='keep stepping after saturation')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--enumerate', type=int, metavar='TOKENS',
+                        help='benchmark token enumeration with this many tokens instead of running the load test')
+    parser.add_argument('--herd', type=int, metavar='THREADS',
+                        help='release this many threads at once on one serial and count the DLL calls instead of '
+                             'running the load test')
+    args = parser.parse_args(argv)
+
+    if args.herd:
+        print(f"herd of {args.herd} threads on one serial")
+        for name, value in benchmark_herd(args.herd, args.latency_ms / 1000).items():
+            print(f"{name:>22} {value:>10}")
+        return
+
+    if args.enumerate:
+        print(f"enumeration of {args.enumerate} tokens")
+        for name, value in benchmark_enumeration(args.enumerate, args.latency_ms / 1000).items():
+            print(f"{name:>22} {value:>10.2f}")
+        return
+
+    config = LoadConfig(
+        mode=args.mode,
+        token_count=args.tokens,
+        pins=tuple(args.pins.split(',')),
+        latency=args.latency_ms / 1000,
+        jitter=args.jitter_ms / 1000,
+        error_rate=args.error_rate,
+        duration=args.duration,
+        seed=args.seed,
+    )
+    steps = [int(step) for step in args.steps.split(',') if step]
+
+    print(f"mode={config.mode} tokens={config.token_count} latency={args.latency_ms}ms+/-{args.jitter_ms}ms "
+          f"error_rate={config.error_rate} duration={config.duration}s")
+    print(f"{'workers':>7} {'requests':>9} {'errors':>7} {'req/s':>10} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+          f"{'max ms':>8} {'dll calls':>9}  time_left")
+    steps_run = run(config, steps, args.saturation_gain, not args.all_steps)
+    while True:
+        try:
+            print(format_step(next(steps_run)), flush=True)
+        except StopIteration as done:
+            saturation: Optional[StepResult] = done.value
+            break
+    if saturation:
+        print(f"saturation: {saturation.workers} workers at {saturation.throughput:.1f} req/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -4,24 +4,59 @@ This module wraps the stauto32.dll calls using
 ctypes to get the current code from the token
 """
 from __future__ import annotations
+import contextvars
 import platform
 import logging
-from typing import List, Dict, NamedTuple, Tuple, Any, ByteString, Union
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import List, Dict, NamedTuple, Tuple, Any, ByteString, Union, Iterable, Iterator, Optional, Deque, \
+    Hashable
 from pathlib import Path
 from collections import namedtuple
 from datetime import date
-from ctypes import c_long, c_int, c_char_p, c_void_p, windll, cdll, byref, create_string_buffer, pointer, POINTER, \
-    c_int64
+from ctypes import c_long, c_int, c_char_p, c_void_p, cdll, byref, create_string_buffer, pointer, POINTER, c_int64
 from ctypes.wintypes import DWORD, INT, LONG, LPLONG, LPVOID, LPDWORD, LPSTR, LPCSTR, LPBOOL
-from ._sdauto import ck_date, token_basic_info, token_error_info, TokenError
+from ._sdauto import ck_date, token_basic_info, token_basic_info_fields, token_basic_info_columns, token_error_info, \
+    TokenError, c_string
+from ._scheduler import RequestScheduler, RequestOptions, current_request_options, PRIORITY_INTERACTIVE
+from ._singleflight import SingleFlight
+from ._snapshot import SnapshotRecord, read_snapshot, write_snapshot
+from .tracing import TraceHook, traced_call
+from ._watchdog import DLLWatchdog, ServiceUnavailableError
+
+try:
+    from ctypes import windll
+except ImportError:
+    # windll only exists on Windows. Other platforms load the library with cdll or use a stand-in backend.
+    windll = None
 
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
+# stauto32 exports return > 0 on success. GetTokenError only reads back the last error, so its result says nothing
+# about the health of the token service and is left out of the circuit breaker counts.
+_DIAGNOSTIC_EXPORTS = frozenset(('GetTokenError',))
+
+
+def _call_succeeded(return_code: Any) -> bool:
+    return return_code > 0
+
+
+def _call_not_judged(return_code: Any) -> None:
+    return None
+
+
+# platform.architecture() can shell out to inspect the interpreter binary, so only ask once
+_IS_64BIT: bool = platform.architecture()[0] == "64bit"
+
 if platform.system() == "Darwin":
     """ Support Mac OS """
     logger.debug("Identified Darwin system. Setting up Mac Darwin OS typedefs for wintypes names.")
-    if platform.architecture()[0] == "64bit":
+    if _IS_64BIT:
         logger.debug("Identified 64-bit Darwin system. Setting BOOL and INT to c_int64")
         BOOL = c_int64
         INT = c_int64
@@ -39,6 +74,55 @@ if platform.system() == "Darwin":
     LPDWORD = POINTER(DWORD)
     LPVOID = c_void_p
 
+# What the Token code methods return
+TokenInfo = namedtuple('TokenInfo', 'passcode tokencode time_left')
+
+
+class TokenColumns(NamedTuple):
+    """
+    Columnar token enumeration from SDProcess.get_token_columns
+    """
+    serials: List[str]
+    usernames: List[str]
+    default_index: int
+
+# sdtid token files carry the serial in an SN element
+_SDTID_SERIAL = re.compile(r'<SN>\s*(\d+)\s*</SN>')
+# CTF strings are digits, usually in dash separated groups, or a link with the digits in its ctfData param
+# (e.g. com.rsa.securid://ctf?ctfData=2000...)
+_CTF_STRING = re.compile(r'^\d[\d\s-]*$')
+_CTF_URL = re.compile(r'^[a-z][\w.+-]*://\S*?[?&]ctfData=([\d-]+)', re.IGNORECASE)
+
+
+def _token_string_data(token: str) -> Optional[str]:
+    """
+    :return: the data to import if token is a token string (sdtid XML or CTF), or None if it should be a file path.
+        CTF strings and links are reduced to the bare digits.
+    """
+    text = token.strip()
+    if text.startswith('<'):
+        return token
+    match = _CTF_URL.match(text)
+    if match:
+        return match.group(1).replace('-', '')
+    if _CTF_STRING.match(text):
+        return re.sub(r'[\s-]', '', text)
+    return None
+
+
+class ImportResult(NamedTuple):
+    """
+    The outcome of importing one token with SDProcess.import_tokens
+    :param source: the file path, or the first characters of the token string
+    :param serial: the token serial if it could be read from the token data
+    :param status: 'imported', 'duplicate' or 'failed'
+    :param error: the token service error for duplicates and failures
+    """
+    source: str
+    serial: Optional[str]
+    status: str
+    error: str = ''
+
 
 class Token:
     """
@@ -47,24 +131,28 @@ class Token:
     """
 
     def __init__(self, serial, token_data: Dict):
-        logger.debug('Initializing token with token data.')
         self.serial_number: str = serial
         self.process: SDProcess = token_data.get('token_service', None)
         if not self.process:
             logger.warning("New token created without SD process. No active process methods will work.")
-        logger.debug(f'SDProcess object: {self.process}')
-        logger.debug(f'Serial: {self.serial_number}')
         self.username: str = token_data.get('username', None)
-        logger.debug(f'Username: {self.username}')
         self.deviceID: str = token_data.get('device_id', None)
-        logger.debug(f'DeviceID: {self.deviceID}  (May be unused)')
         self.descriptor: str = token_data.get('descriptor', None)
-        logger.debug(f'Descriptor: {self.descriptor}  (May be unused)')
         self.is_default: bool = token_data.get('is_default', False)
-        logger.debug(f'Default: {self.is_default}')
         # If a pin-style is not given, default to PINLess
         self.pin_style: str = token_data.get("pin_style", SDProcess.valid_pin_styles[0])
-        logger.debug(f'Pin-Style: {self.pin_style}')
+
+        # Tokens are built by the thousand when enumerating large token stores. Only format the details if they
+        # will be logged.
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Initializing token with token data.')
+            logger.debug(f'SDProcess object: {self.process}')
+            logger.debug(f'Serial: {self.serial_number}')
+            logger.debug(f'Username: {self.username}')
+            logger.debug(f'DeviceID: {self.deviceID}  (May be unused)')
+            logger.debug(f'Descriptor: {self.descriptor}  (May be unused)')
+            logger.debug(f'Default: {self.is_default}')
+            logger.debug(f'Pin-Style: {self.pin_style}')
 
     def __repr__(self):
         # The most useful info (IMHO) is serial and pin-style. Serial is required and pin-style helps determine
@@ -99,11 +187,39 @@ class Token:
             logger.critical('No SDProcess found while getting current token code!')
             raise ReferenceError("No SDProcess found")
 
-        TokenInfo = namedtuple('TokenInfo', 'passcode tokencode time_left')
         # use the *args syntax to break the returned tuple into 3 items
         logger.info(f'Calling SDProcess to get current code for token {self.serial_number}')
         return TokenInfo(*self.process.get_token_current_code(self.serial_number, self.pin_style, pin))
 
+    def get_current_codes(self, pins: Iterable[str]) -> List[NamedTuple]:
+        """
+        Get the current code for several pins. Fob-style passcodes are the pin prepended to the tokencode and PINless
+        passcodes are the tokencode, so for those styles the tokencode is fetched once and the passcodes are composed
+        here. PINPad-style tokens roll the pin into the tokencode, so they still need one SDProcess call per pin.
+
+        :param pins: the pins to build passcodes for
+        :return: a list of named tuples of passcode, tokencode, and time left in the same order as pins
+        """
+        if not self.process:
+            logger.critical('No SDProcess found while getting current token codes!')
+            raise ReferenceError("No SDProcess found")
+
+        pins = list(pins)
+        if not pins:
+            return []
+        if self.pin_style == "PINPad-style":
+            logger.info(f'PINPad-style token {self.serial_number}. Getting {len(pins)} codes from SDProcess')
+            return [self.get_current_code(pin) for pin in pins]
+
+        logger.info(f'Calling SDProcess once to get current code for {len(pins)} pins on token {self.serial_number}')
+        _, tokencode, time_left = self.process.get_token_current_code(self.serial_number, self.pin_style)
+        if not tokencode:
+            # The call failed. Same result get_current_code would give for each pin.
+            return [TokenInfo('', '', time_left) for _ in pins]
+        if self.pin_style == "Fob-style":
+            return [TokenInfo(pin + tokencode, tokencode, time_left) for pin in pins]
+        return [TokenInfo(tokencode, tokencode, time_left) for _ in pins]
+
     def get_next_code(self, pin: str = '') -> NamedTuple:
         """
         Calls the SDProcess to get the next code from the token with the given serial
@@ -114,7 +230,6 @@ class Token:
             logger.critical('No SDProcess found while getting next token code!')
             raise ReferenceError("No SDProcess found")
 
-        TokenInfo = namedtuple('TokenInfo', 'passcode tokencode time_left')
         logger.info(f'Calling SDProcess to get next code for token {self.serial_number}')
         return TokenInfo(*self.process.get_token_next_code(self.serial_number, pin))
 
@@ -149,12 +264,27 @@ class SDProcess:
     :param log_level: set the logging level for the class
     :param pin_length: pins can be 6-8 alphanumeric characters or 0 for pinless tokens
     :param tokencode_length: tokencodes can be 6-8 digits
+    :param backend: an already loaded library (or a stand-in with the same exports) to use instead of loading dll_name
+    :param snapshot_path: file for a snapshot of the enumerated tokens. If the snapshot matches the live token count
+        and default token, the tokens are built from it instead of being enumerated again.
+    :param call_timeout: seconds any DLL call may run. When set, DLL calls run on supervised worker threads and a
+        circuit breaker fails calls fast (CircuitOpenError) after failure_threshold consecutive failures or
+        timeouts (CallTimeoutError), probing again after reset_timeout seconds. A call that waits longer than
+        call_timeout for a free worker raises QueueTimeoutError and doesn't count against the breaker. None calls
+        the DLL directly.
+    :param failure_threshold: consecutive failures that open the circuit
+    :param reset_timeout: seconds the circuit stays open before a probe call
+    :param call_workers: number of worker threads making DLL calls when call_timeout is set
+    :param max_concurrent_calls: when set, DLL calls go through a scheduler that allows this many in flight and
+        orders the rest by priority (see request_options). None calls the DLL without scheduling.
     """
     # This is what RSA calls the pin styles
     valid_pin_styles: List[str] = ("PINless", "PINPad-style", "Fob-style")
 
     def __init__(self, dll_name: str = '', log_level:str = 'WARNING', pin_length: int = 8, tokencode_length: int = 8,
-                 pin_style:str = "PINless"):
+                 pin_style:str = "PINless", backend: Any = None, snapshot_path: Union[str, Path, None] = None,
+                 call_timeout: Optional[float] = None, failure_threshold: int = 5, reset_timeout: float = 30.0,
+                 max_concurrent_calls: Optional[int] = None, call_workers: int = 1):
         # Set the logging level
         n_log_level: int
         if log_level.casefold() == 'NOTSET'.casefold():
@@ -176,6 +306,22 @@ class SDProcess:
         if log_level != '':
             logger.setLevel(n_log_level)
 
+        self.snapshot_path: Optional[Path] = Path(snapshot_path).expanduser() if snapshot_path else None
+
+        # Registered tracing hooks
+        self._trace_hooks: Tuple[TraceHook, ...] = ()
+        # Supervised worker and circuit breaker for DLL calls (None calls the DLL on the caller's thread)
+        self.watchdog: Optional[DLLWatchdog] = None
+        if call_timeout is not None:
+            self.watchdog = DLLWatchdog(call_timeout, failure_threshold, reset_timeout, call_workers)
+        # Priority and deadline scheduling of DLL calls (None calls the DLL as soon as it is asked)
+        self.scheduler: Optional[RequestScheduler] = None
+        if max_concurrent_calls is not None:
+            self.scheduler = RequestScheduler(max_concurrent_calls)
+        # True when hooks, the watchdog and the scheduler are all unused, so plain DLL calls cost a single attribute
+        # check
+        self._direct_calls: bool = self.watchdog is None and self.scheduler is None
+
         logging.debug('Initializing the SDProcess (calling sdauto32 init)')
         # Sanity check
         if pin_style not in self.valid_pin_styles:
@@ -185,7 +331,12 @@ class SDProcess:
             self.pin_style = pin_style
             logger.debug(f'Pin style set to {self.pin_style}')
 
-        if dll_name:  # Passed in from init args
+        if backend is not None:  # Already loaded library or stand-in (load testing)
+            self.dll_name = getattr(backend, 'name', repr(backend))
+            logger.debug(f'Using the provided backend {self.dll_name}')
+            self.process = backend
+
+        elif dll_name:  # Passed in from init args
             self.dll_name = dll_name
             logger.debug(f'DLL name set to {self.dll_name} from arguments')
             self.process = windll.LoadLibrary(self.dll_name)
@@ -194,7 +345,7 @@ class SDProcess:
             logger.debug("No dll name passed in during initialization. Determining correct default from platform/arch")
             if platform.system() == 'Windows':
                 logger.debug("This is a windows platform.")
-                if platform.architecture()[0] == "64bit":
+                if _IS_64BIT:
                     logger.debug("This is a 64-bit platform.")
                     dll_path = Path(r"C:\Program Files\RSA SecurID Token Common\stauto32.dll")
                     logger.info(f"Using path {dll_path}")
@@ -248,6 +399,11 @@ class SDProcess:
 
         logger.info("Setting up SDProcess vars.")
         self.tokens: List[Any] = []
+        # serial -> Token. Rebuilt with self.tokens.
+        self._serial_index: Dict[str, Token] = {}
+        self._import_lock = threading.Lock()
+        # Coalesces concurrent identical get_token_current_code calls
+        self._current_code_calls: SingleFlight = SingleFlight()
         self.lTokens: c_long = LONG()
         self.lTokenServiceHandle: c_long = LONG()
         self.lDefaultToken: c_long = LONG()
@@ -263,9 +419,98 @@ class SDProcess:
         self._enum_tokens()
         logger.debug(f"There are {self.lTokens.value} tokens.")
 
-        # Populate the token dict
-        logger.info("Populating token dictionary from init")
-        self.tokens = self._get_tokens()
+        # Populate the token dict. The first EnumToken call gave the count and default index, which is enough to
+        # tell if the snapshot is still current.
+        snapshot_tokens: Optional[List[Token]] = self._load_snapshot() if self.snapshot_path else None
+        if snapshot_tokens is not None:
+            logger.info(f"Populating token dictionary from snapshot {self.snapshot_path}")
+            self.tokens = snapshot_tokens
+        else:
+            logger.info("Populating token dictionary from init")
+            self.tokens = self._get_tokens()
+            if self.snapshot_path:
+                self._write_snapshot()
+        self._serial_index = {token.serial_number: token for token in self.tokens}
+
+    def add_trace_hook(self, hook: TraceHook) -> None:
+        """
+        Register a callable that receives a pysdtoken.tracing.TraceEvent at the start and end of every DLL call
+        :param hook: callable taking a TraceEvent
+        """
+        logger.debug(f"Adding trace hook {hook}")
+        self._trace_hooks = self._trace_hooks + (hook,)
+        self._direct_calls = False
+
+    def remove_trace_hook(self, hook: TraceHook) -> None:
+        """
+        Unregister a trace hook added with add_trace_hook
+        :param hook: the registered callable
+        """
+        if hook not in self._trace_hooks:
+            raise ValueError(f"Trace hook {hook} is not registered")
+        logger.debug(f"Removing trace hook {hook}")
+        hooks = list(self._trace_hooks)
+        hooks.remove(hook)
+        self._trace_hooks = tuple(hooks)
+        self._direct_calls = not self._trace_hooks and self.watchdog is None and self.scheduler is None
+
+    def _dll_call(self, func: Any, serial: Union[str, None], *args) -> Any:
+        """
+        Call a stauto32 export. Every DLL call goes through here so tracing hooks see all of them.
+        :param func: the ctypes function pointer
+        :param serial: the token serial the call is for, or None for service-level calls
+        :param args: the arguments for the export
+        :return: the export's return value
+        """
+        if self._direct_calls:
+            return func(*args)
+        if self.scheduler is not None:
+            with self.scheduler.slot(current_request_options.get()):
+                return self._guarded_call(func, serial, args)
+        return self._guarded_call(func, serial, args)
+
+    def _guarded_call(self, func: Any, serial: Union[str, None], args: Tuple) -> Any:
+        """
+        Make a DLL call with tracing and/or the watchdog
+        """
+        export: str = getattr(func, '__name__', '')
+        if self._trace_hooks:
+            # Name the calling thread here. With the watchdog on, traced_call runs on a DLL worker.
+            args = (self._trace_hooks, func, serial, args, threading.current_thread().name)
+            func = traced_call
+        if self.watchdog is not None:
+            succeeded = _call_not_judged if export in _DIAGNOSTIC_EXPORTS else _call_succeeded
+            return self.watchdog.call(func, args, export, succeeded)
+        return func(*args)
+
+    @contextmanager
+    def request_options(self, priority: str = PRIORITY_INTERACTIVE, timeout: Optional[float] = None,
+                        job: Optional[Hashable] = None):
+        """
+        Context manager that sets the scheduling options for every call made in it (including calls made by the
+        Token methods). Only used when SDProcess was created with max_concurrent_calls.
+        :param priority: 'interactive' (default) or 'batch'. Waiting interactive requests always run first.
+        :param timeout: seconds from now after which waiting requests are dropped with DeadlineExceededError
+        :param job: batch requests are shared round-robin between jobs. Defaults to the calling thread.
+        """
+        deadline: Optional[float] = None if timeout is None else time.monotonic() + timeout
+        token = current_request_options.set(RequestOptions(priority, deadline, job))
+        try:
+            yield
+        finally:
+            current_request_options.reset(token)
+
+    def scheduler_stats(self) -> Optional[Dict[str, Any]]:
+        """
+        :return: queue depth, admitted and dropped counts and wait times per priority, or None without a scheduler
+        """
+        return self.scheduler.stats() if self.scheduler else None
+
+    def circuit_state(self) -> Optional[str]:
+        """
+        :return: the circuit breaker state ('closed', 'open' or 'half-open'), or None without a call timeout
+        """
+        return self.watchdog.breaker.state if self.watchdog else None
 
     def _open_service(self):
         """
@@ -275,7 +520,7 @@ class SDProcess:
         # No idea how to typecheck ctypes function pointers
         svc_open: Any = self.process.OpenTokenService
 
-        if platform.architecture()[0] == "64bit":
+        if _IS_64BIT:
             logger.debug("Setting return type of OpenTokenService to c_int64")
             svc_open.restype = c_int64
         else:
@@ -287,10 +532,13 @@ class SDProcess:
         try:
             # > 0 means success and dwBuffersize is set
             logger.debug("Calling OpenTokenService function with ctypes")
-            if svc_open(self.lTokenServiceHandle) > 0:
+            if self._dll_call(svc_open, None, self.lTokenServiceHandle) > 0:
                 logger.debug(f"Token service started, handle {self.lTokenServiceHandle.value}.")
             else:
                 logger.error("No token service found!")
+        except ServiceUnavailableError:
+            # Timeouts and an open circuit go to the caller so it can fail fast
+            raise
         except Exception as e:
             logger.debug(e)
             logger.error(f"Error opening token service: {e}")
@@ -301,7 +549,7 @@ class SDProcess:
         tokens using the sdauto32.dll typelib
         """
         svc_close: Any = self.process.CloseTokenService
-        if platform.architecture()[0] == "64bit":
+        if _IS_64BIT:
             logger.debug("Setting return type of OpenTokenService to c_int64")
             svc_close.restype = c_int64
         else:
@@ -314,7 +562,7 @@ class SDProcess:
         try:
             # > 0 means success
             logger.debug("Calling CloseTokenService function with ctypes")
-            if svc_close(self.lTokenServiceHandle) > 0:
+            if self._dll_call(svc_close, None, self.lTokenServiceHandle) > 0:
                 self.lTokenServiceHandle = None
                 logger.debug("Token Service closed")
             else:
@@ -325,6 +573,9 @@ class SDProcess:
             logger.debug(e)
             logger.error("Error closing service.")
 
+        if self.watchdog is not None:
+            self.watchdog.shutdown()
+
     def _enum_tokens(self) -> DWORD:
         """
         Python wrapper for the C++ call using ctypes this method should return a handle to the process that manages
@@ -338,7 +589,7 @@ class SDProcess:
         """
         svc_enum: Any = self.process.EnumToken
 
-        if platform.architecture()[0] == "64bit":
+        if _IS_64BIT:
             logger.debug("Setting return type of EnumToken to c_int64")
             svc_enum.restype = c_int64
         else:
@@ -350,7 +601,9 @@ class SDProcess:
         # See if there are any registered tokens and set up the buffer
         try:
             logger.debug("Calling EnumToken function with ctypes to get the buffer size first")
-            svc_enum(
+            self._dll_call(
+                svc_enum,
+                None,
                 self.lTokenServiceHandle,
                 self.lTokens,  # lTokens gets filled with token count. Don't provide a token array pointer yet
                 self.lDefaultToken,
@@ -358,6 +611,9 @@ class SDProcess:
                 self.dwBuffersize
             )
 
+        except ServiceUnavailableError:
+            # Timeouts and an open circuit go to the caller so it can fail fast
+            raise
         except Exception as e:
             logger.debug(e)
             logger.error("Error getting number of tokens.")
@@ -369,35 +625,30 @@ class SDProcess:
             self.get_token_error()
             return DWORD(0)
 
-    def _get_tokens(self) -> List[Token]:
+    def _read_token_buffer(self) -> memoryview:
         """
-        Python wrapper for the C++ call using ctypes. This method should return a list of tokeninfo objects from the
-        process as tokeninfo structs from c++. The python methods will parse these structs into usable Token class
-        objects. The number of tokens registered with the token service was obtained by EnumToken. The self.lTokens
-        var contains a count. self.lDefaultToken gets filled with the index of the system default token in the returned
-        array. The default token will be used for all deprecated calls that don't pass in a serial. The default can be
-        changed with the SelectToken method if I ever implement it.
-        :return: DWORD
+        Python wrapper for the second EnumToken call. The number of tokens registered with the token service was
+        obtained by the first EnumToken call in _enum_tokens. This call fills an array of TOKENBASICINFO structs and
+        self.lDefaultToken gets the index of the system default token in that array.
+        :return: a memoryview over the raw bytes of the filled array (empty if there are no tokens)
         """
-
-        # First, see if there are any registered tokens. If not, return an empty dict
+        # First, see if there are any registered tokens. If not, return an empty buffer
         logger.debug("Checking to see if there is a token count before getting tokens. Was EnumToken successful?")
-        if self.lTokens.value == 0:
+        if self.lTokens.value <= 0:
             logger.debug("There are no registered tokens.")
-            return []
+            return memoryview(b'')
 
         # Create an array of token structs
         logger.debug("Tokens are registered. Create a pointer to an array of empty TOKENBASICINFO structs to pass in")
         # I don't understand how to typecheck ctypes arrays of structs
         lpTokens: Any = (token_basic_info * self.lTokens.value)()
-        tokens: List = []
 
         # There are lTokens # of tokens. Get them in an array. The dwBuffersize has to have been set
         # previously, which is done during init in the enum_tokens() call. If dwBuffer points to a
         # null DWORD, the function will return zero/false and fill dwBuffersize with the correct size
         svc_enum: Any = self.process.EnumToken
 
-        if platform.architecture()[0] == "64bit":
+        if _IS_64BIT:
             logger.debug("Setting return type of EnumToken to c_int64")
             svc_enum.restype = c_int64
         else:
@@ -411,7 +662,9 @@ class SDProcess:
         try:
             logger.debug("Calling EnumToken function with ctypes to get the tokens second")
 
-            if svc_enum(
+            if self._dll_call(
+                    svc_enum,
+                    None,
                     self.lTokenServiceHandle,
                     byref(self.lTokens),
                     byref(self.lDefaultToken),
@@ -423,42 +676,74 @@ class SDProcess:
                 logger.error("Did not find any tokens.")
                 self.get_token_error()
 
+        except ServiceUnavailableError:
+            # Timeouts and an open circuit go to the caller so it can fail fast
+            raise
         except Exception as e:
             logger.debug(e)
             logger.error("Error getting tokens.")
             self.get_token_error()
-            return []
+            return memoryview(b'')
 
-        # Grab the token basic info for each token into a Token array. All stauto32 strings are utf-8
-        logger.debug("Parsing tokenbasicinfo structs frrom list into python dicts")
-        for x, token in enumerate(lpTokens):
-            logger.debug("Building token data dict from ctypes return data")
-            token_data: Dict[str, Union[str, SDProcess, bool]] = {}
-            token_data.update({'token_service': self})
-            logger.debug(f"Added token service (self) {self}")
-            token_data.update({'username': token.username.decode('utf-8')})
-            logger.debug(f"Added username {token_data['username']}")
-            token_data.update({'device_id': token.deviceID})
-            logger.debug(f"Added device_id {token_data['device_id']}")
-            token_data.update({'descriptor': token.descriptor})
-            logger.debug(f"Added descriptor {token_data['descriptor']}")
-            serial: str = token.serial_number.decode('utf-8')
-            logger.debug(f"Added serial number {serial}")
-
-            # Check to see if we're the default token
-            if self.lDefaultToken.value == x:
-                logger.info("Identified the default token")
-                token_data.update({'is_default': True})
-            else:
-                logger.debug("This token is not the default")
-                token_data.update({'is_default': False})
-
-            logger.debug(f"Append new token {serial} to token list")
-            tokens.append(Token(serial, token_data))
+        # The service may report fewer tokens than the array holds. Don't parse the empty tail.
+        count: int = max(0, min(self.lTokens.value, len(lpTokens)))
+        return memoryview(lpTokens).cast('B')[:count * token_basic_info_fields.size]
 
-        logging.debug(f"Return the {self.lTokens.value}-token list to the calling process")
+    def _get_tokens(self) -> List[Token]:
+        """
+        Get the registered tokens from the token service and parse them into Token objects. Tokens that are already
+        in the serial index keep their Token objects. The default token will be used for all deprecated calls that
+        don't pass in a serial. The default can be changed with the SelectToken method if I ever implement it.
+        :return: List[Token]
+        """
+        buffer: memoryview = self._read_token_buffer()
+        default_index: int = self.lDefaultToken.value
+        tokens: List[Token] = []
+
+        # Unpack straight from the array bytes instead of copying each struct field through ctypes attributes.
+        # All stauto32 strings are utf-8 and NUL padded.
+        logger.debug("Parsing tokenbasicinfo structs from the EnumToken buffer")
+        for x, (serial, username, device_id, descriptor) in enumerate(token_basic_info_fields.iter_unpack(buffer)):
+            serial: str = c_string(serial)
+            known_token: Token = self._serial_index.get(serial)
+            if known_token:
+                # Re-enumeration. Keep the existing Token (and its pin style) and refresh its info.
+                known_token.username = c_string(username)
+                known_token.deviceID = c_string(device_id)
+                known_token.descriptor = c_string(descriptor)
+                known_token.is_default = x == default_index
+                tokens.append(known_token)
+                continue
+
+            tokens.append(Token(serial, {
+                'token_service': self,
+                'username': c_string(username),
+                'device_id': c_string(device_id),
+                'descriptor': c_string(descriptor),
+                'is_default': x == default_index,
+            }))
+
+        buffer.release()
+        logger.debug(f"Return the {len(tokens)}-token list to the calling process")
         return tokens
 
+    def get_token_columns(self) -> TokenColumns:
+        """
+        Enumerate the token service and return the serials and usernames as columns without building Token objects.
+        Cheaper than refresh_tokens when only the serials and usernames of a large token store are needed.
+        :return: TokenColumns of serials, usernames and the default token index
+        """
+        logger.info("Enumerating token columns")
+        self._enum_tokens()
+        buffer: memoryview = self._read_token_buffer()
+        serials: List[str] = []
+        usernames: List[str] = []
+        for serial, username in token_basic_info_columns.iter_unpack(buffer):
+            serials.append(c_string(serial))
+            usernames.append(c_string(username))
+        buffer.release()
+        return TokenColumns(serials, usernames, self.lDefaultToken.value)
+
     def get_default_token(self) -> Token:
         """
         Try to get the default token handle based on the default token index
@@ -476,15 +761,94 @@ class SDProcess:
         :return: Token
         """
         logger.debug(f"Getting a token by serial number ({serial})")
-        for token in self.tokens:
-            logger.debug(f"Comparing {token.serial_number} and {serial}")
-            if token.serial_number == serial:
-                logger.debug(f"Match: returning token {serial}")
-                return token
+        token: Token = self._serial_index.get(serial)
+        if token:
+            logger.debug(f"Match: returning token {serial}")
+            return token
 
         logger.warning("No match found.")
 
+    def refresh_tokens(self) -> List[Token]:
+        """
+        Re-enumerate the token service. Tokens that were already known keep their Token objects (and pin styles),
+        new tokens are added and removed tokens are dropped.
+        :return: the refreshed token list
+        """
+        logger.info("Re-enumerating tokens")
+        self._enum_tokens()
+        self.tokens = self._get_tokens()
+        self._serial_index = {token.serial_number: token for token in self.tokens}
+        if self.snapshot_path:
+            self._write_snapshot()
+        return self.tokens
+
+    def _load_snapshot(self) -> Optional[List[Token]]:
+        """
+        Build the tokens from the snapshot file if it matches the live token count and default token index
+        :return: List[Token] or None if the snapshot is missing or stale
+        """
+        records: Optional[List[SnapshotRecord]] = read_snapshot(
+            self.snapshot_path, self.lTokens.value, self.lDefaultToken.value
+        )
+        if records is None:
+            logger.info(f"Snapshot {self.snapshot_path} is missing or stale. Enumerating tokens.")
+            return None
+
+        default_index: int = self.lDefaultToken.value
+        return [
+            Token(record.serial, {
+                'token_service': self,
+                'username': record.username,
+                'device_id': record.device_id,
+                'descriptor': record.descriptor,
+                'is_default': x == default_index,
+                'pin_style': self.valid_pin_styles[record.pin_style]
+                if record.pin_style < len(self.valid_pin_styles) else self.valid_pin_styles[0],
+            })
+            for x, record in enumerate(records)
+        ]
+
+    def save_snapshot(self, path: Union[str, Path, None] = None) -> None:
+        """
+        Write the current token metadata (including each token's pin style) to a snapshot file. The snapshot is
+        written automatically when tokens are enumerated. Call this to persist pin style changes.
+        :param path: the snapshot file. Defaults to the snapshot_path given to SDProcess.
+        """
+        path = Path(path).expanduser() if path else self.snapshot_path
+        if not path:
+            raise ValueError("No snapshot path given")
+        write_snapshot(path, [
+            SnapshotRecord(
+                token.serial_number,
+                token.username or '',
+                token.deviceID or '',
+                token.descriptor or '',
+                self.valid_pin_styles.index(token.pin_style),
+            )
+            for token in self.tokens
+        ], self.lDefaultToken.value)
+        logger.debug(f"Wrote snapshot of {len(self.tokens)} tokens to {path}")
+
+    def _write_snapshot(self) -> None:
+        # A snapshot that can't be written only costs the next start an enumeration
+        try:
+            self.save_snapshot()
+        except Exception as e:
+            logger.debug(e)
+            logger.warning(f"Could not write token snapshot {self.snapshot_path}")
+
     def get_token_current_code(self, serial: str, pin_style: str, pin: str = '') -> Tuple[ByteString, Any, int]:
+        # Concurrent requests for the same serial, pin style and pin share one GetCurrentCode call. Only the call in
+        # flight is shared. Nothing is cached after it returns. Priorities are kept apart so an interactive request
+        # never waits on a queued batch request. Each caller waits no longer than its own deadline.
+        options: RequestOptions = current_request_options.get()
+        return self._current_code_calls.do(
+            (serial, pin_style, pin, options.priority),
+            self._get_token_current_code, serial, pin_style, pin,
+            deadline=options.deadline
+        )
+
+    def _get_token_current_code(self, serial: str, pin_style: str, pin: str = '') -> Tuple[ByteString, Any, int]:
         # The Pièce de résistance of this lib. Get the current code that would be displayed on the token screen
         # return a tuple of code + time-left.
 
@@ -517,7 +881,7 @@ class SDProcess:
 
         svc_get_code: Any = self.process.GetCurrentCode
 
-        if platform.architecture()[0] == "64bit":
+        if _IS_64BIT:
             logger.debug("Setting return type of GetCurrentCode to c_int64")
             svc_get_code.restype = c_int64
         else:
@@ -529,7 +893,9 @@ class SDProcess:
 
         logger.debug("Calling GetCurrentCode with ctypes.")
         try:
-            if self.process.GetCurrentCode(
+            if self._dll_call(
+                svc_get_code,
+                serial,
                 self.lTokenServiceHandle,
                 serial.encode("utf-8"),
                 chPIN,
@@ -541,6 +907,9 @@ class SDProcess:
             else:
                 logger.error("We did not successdully call the GetCurrentCode function")
 
+        except ServiceUnavailableError:
+            # Timeouts and an open circuit go to the caller so it can fail fast
+            raise
         except Exception as e:
             logger.debug(e)
             logger.error("Error getting token code.")
@@ -559,7 +928,7 @@ class SDProcess:
         logger.debug("Checking if next code is blocked")
         svc_can_get_next: Any = self.process.CanTokenGetNextCode
 
-        if platform.architecture()[0] == "64bit":
+        if _IS_64BIT:
             logger.debug("Setting return type of GetNextCode to c_int64")
             svc_can_get_next.restype = c_int64
         else:
@@ -573,7 +942,9 @@ class SDProcess:
         logger.debug("Calling CanTokenGetNextCode with ctypes.")
 
         try:
-            if svc_can_get_next(
+            if self._dll_call(
+                svc_can_get_next,
+                serial,
                 self.lTokenServiceHandle,
                 serial.encode('utf-8'),
                 can_it_tho
@@ -583,6 +954,9 @@ class SDProcess:
                 logger.error("Call to CanTokenGetNextCode failed")
                 self.get_token_error()
 
+        except ServiceUnavailableError:
+            # Timeouts and an open circuit go to the caller so it can fail fast
+            raise
         except Exception as e:
             logger.debug(e)
             logger.error("Error getting next token code.")
@@ -625,7 +999,7 @@ class SDProcess:
 
         svc_get_next: Any = self.process.GetNextCode
 
-        if platform.architecture()[0] == "64bit":
+        if _IS_64BIT:
             logger.debug("Setting return type of GetNextCode to c_int64")
             svc_get_next.restype = c_int64
         else:
@@ -637,7 +1011,9 @@ class SDProcess:
 
         logger.debug("Calling GetNextCode with ctypes.")
         try:
-            self.process.GetNextCode(
+            self._dll_call(
+                svc_get_next,
+                serial,
                 self.lTokenServiceHandle,
                 serial.encode("utf-8"),
                 chPIN,
@@ -645,6 +1021,9 @@ class SDProcess:
                 chPASSCODE,
                 chPRN
             )
+        except ServiceUnavailableError:
+            # Timeouts and an open circuit go to the caller so it can fail fast
+            raise
         except Exception as e:
             logger.debug(e)
             logger.error("Error getting next token code.")
@@ -659,7 +1038,7 @@ class SDProcess:
 
         svc_get_exp: Any = self.process.GetTokenExpirationDate
 
-        if platform.architecture()[0] == "64bit":
+        if _IS_64BIT:
             logger.debug("Setting return type of GetTokenExpirationDate to c_int64")
             svc_get_exp.restype = c_int64
         else:
@@ -673,7 +1052,9 @@ class SDProcess:
         # Get the struct and parse it - Should I use datetime library here instead of a string?
         try:
             # > 0 means success
-            if self.process.GetTokenExpirationDate(
+            if self._dll_call(
+                    svc_get_exp,
+                    serial,
                     self.lTokenServiceHandle,
                     serial.encode('utf-8'),
                     expiration_date
@@ -687,6 +1068,9 @@ class SDProcess:
                 self.get_token_error()
                 logger.warning("GetTokenExpirationDate returned 0")
                 printable_date: date = None
+        except ServiceUnavailableError:
+            # Timeouts and an open circuit go to the caller so it can fail fast
+            raise
         except Exception as e:
             logger.debug(e)
             logger.error("Error getting token expiration date.")
@@ -695,6 +1079,143 @@ class SDProcess:
 
         return printable_date
 
+    def import_tokens(self, tokens: Iterable[Tuple[Union[str, Path], Optional[str]]],
+                      max_workers: int = 4) -> Iterator[ImportResult]:
+        """
+        Import token files or token strings into the token service. Items are read and checked by up to max_workers
+        threads with at most 2 * max_workers items in flight, so large iterables are streamed. Tokens whose serial is
+        already registered (or earlier in the same batch) are skipped without a DLL call. The tokens are re-enumerated
+        once when the import finishes, not after every token.
+
+        Token data can be a Path to a token file, a str path to a token file, or the token string itself (sdtid XML,
+        a numeric CTF string with or without dashes, or a ctf?ctfData= link). A Path is always read as a file.
+
+        :param tokens: iterable of (token, password) pairs. Use None for tokens without a password.
+        :param max_workers: number of concurrent import workers
+        :return: a generator of ImportResult, in the same order as tokens
+        """
+        pending: Deque[Future] = deque()
+        batch_serials: set = set()
+        imported = 0
+        executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='pysdtoken-import')
+        try:
+            for token, password in tokens:
+                # Run each import in a copy of the caller's context so request_options and trace spans carry over
+                pending.append(executor.submit(
+                    contextvars.copy_context().run, self._import_token, token, password, batch_serials
+                ))
+                if len(pending) >= 2 * max_workers:
+                    result: ImportResult = pending.popleft().result()
+                    imported += result.status == 'imported'
+                    yield result
+            while pending:
+                result: ImportResult = pending.popleft().result()
+                imported += result.status == 'imported'
+                yield result
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+            # The caller may have stopped early. Count imports that finished but were never yielded.
+            imported += sum(
+                1 for future in pending
+                if not future.cancelled() and future.exception() is None and future.result().status == 'imported'
+            )
+            if imported:
+                logger.info(f"Imported {imported} tokens. Re-enumerating once.")
+                self.refresh_tokens()
+
+    def _import_token(self, token: Union[str, Path], password: Optional[str], batch_serials: set) -> ImportResult:
+        """
+        Read one token and import it with the ImportToken export
+        :param token: a token file path or token string
+        :param password: the token file password or None
+        :param batch_serials: serials already imported or in flight in this batch
+        :return: ImportResult
+        """
+        # Token strings are XML (sdtid) or CTF digits or links. Anything else is a file path.
+        string_data: Optional[str] = None if isinstance(token, Path) else _token_string_data(token)
+        if string_data is None:
+            source = str(token)
+            try:
+                data: str = Path(token).read_text(encoding='utf-8')
+            except Exception as e:
+                logger.debug(e)
+                logger.error(f"Could not read token file {source}")
+                return ImportResult(source, None, 'failed', str(e))
+        else:
+            source = token.strip()[:24]
+            data: str = string_data
+
+        match = _SDTID_SERIAL.search(data)
+        serial: Optional[str] = match.group(1) if match else None
+
+        svc_import: Any = self.process.ImportToken
+        if _IS_64BIT:
+            svc_import.restype = c_int64
+        else:
+            svc_import.restype = c_int
+        svc_import.argtypes = [LONG, c_char_p, c_char_p, ]
+
+        # One import at a time: the token service reports the last error per handle, so the call and the error
+        # lookup must not interleave with another import.
+        with self._import_lock:
+            if serial and (serial in self._serial_index or serial in batch_serials):
+                logger.info(f"Token {serial} is already registered. Skipping.")
+                return ImportResult(source, serial, 'duplicate', TokenError.ERROR_DUPLICATE_SERIAL.name)
+
+            logger.debug(f"Calling ImportToken for {source}")
+            try:
+                if self._dll_call(
+                        svc_import,
+                        serial,
+                        self.lTokenServiceHandle,
+                        data.encode('utf-8'),
+                        password.encode('utf-8') if password else None
+                ) > 0:
+                    if serial:
+                        batch_serials.add(serial)
+                    return ImportResult(source, serial, 'imported')
+                error_code: int = self._get_token_error_code()
+            except Exception as e:
+                logger.debug(e)
+                logger.error(f"Error importing token {source}")
+                return ImportResult(source, serial, 'failed', str(e))
+
+        try:
+            error_name: str = TokenError(error_code).name
+        except ValueError:
+            error_name = f"Unknown token error {error_code}"
+        if error_code == TokenError.ERROR_DUPLICATE_SERIAL.value:
+            return ImportResult(source, serial, 'duplicate', error_name)
+        logger.warning(f"Could not import token {source}: {error_name}")
+        return ImportResult(source, serial, 'failed', error_name)
+
+    def _get_token_error_code(self) -> int:
+        """
+        Get the number of the last token error without formatting it
+        :return: the error number, 0 if there is none
+        """
+        token_error: token_error_info = token_error_info()
+        try:
+            if self._dll_call(self.process.GetTokenError, None, self.lTokenServiceHandle, pointer(token_error)) > 0:
+                return INT(token_error.error).value
+        except ServiceUnavailableError as e:
+            logger.debug(e)
+        return 0
+
+    def start_code_board(self, name: Optional[str] = None, serials: Optional[Iterable[str]] = None) -> Any:
+        """
+        Publish the current tokencodes to shared memory for other processes on this host and keep them current at
+        every rollover. Read them with pysdtoken.codeboard.CodeBoardReader(name).
+        :param name: the shared memory segment name. None lets the OS pick one (see the publisher's .name).
+        :param serials: the serials to publish. Defaults to all tokens.
+        :return: the running pysdtoken.codeboard.CodeBoardPublisher. Call close() on it to stop and remove the board.
+        """
+        # Imported here so the token service doesn't pull in multiprocessing unless a board is used
+        from .codeboard import CodeBoardPublisher
+        return CodeBoardPublisher(self, name, list(serials) if serials is not None else None).start()
+
     def get_token_error(self) -> str:
         # Get any token error. Create a TOKENERRORINFO struct
         token_error: token_error_info = token_error_info()
@@ -703,10 +1224,18 @@ class SDProcess:
         lp_token_error = pointer(token_error)
 
         # Call the dll function, pass in the struct pointer to get filled. > 0 is success
-        if self.process.GetTokenError(
+        try:
+            error_found: bool = self._dll_call(
+                self.process.GetTokenError,
+                None,
                 self.lTokenServiceHandle,
                 lp_token_error
-        ) > 0:
+            ) > 0
+        except ServiceUnavailableError as e:
+            logger.debug(e)
+            return f"Token service unavailable: {e}"
+
+        if error_found:
             if lp_token_error and token_error:
                 # Dereference the pointer/get contents
                 content: token_error_info = lp_token_error.contents
@@ -740,6 +1269,10 @@ class SDProcess:
             self.close_service()
         except Exception as e:
             pass
+        # close_service fails before reaching the watchdog if the DLL never loaded
+        watchdog: Optional[DLLWatchdog] = getattr(self, 'watchdog', None)
+        if watchdog is not None:
+            watchdog.shutdown()
 
 
 class NoProcessError(Exception):
@@ -0,0 +1,105 @@
+"""
+Tracing hooks for the DLL calls made by SDProcess
+Hooks are plain callables registered with SDProcess.add_trace_hook. Each DLL call sends a 'start' event before the
+call and an 'end' event after it. Span ids propagate through a contextvar, so a DLL call made while another one is
+still in flight in the same context (e.g. from a hook) names it as its parent, across threads and asyncio tasks that
+copy the context. Follow-up calls made after a call returns, like the GetTokenError after a failed GetCurrentCode,
+are separate spans with no parent. Nothing here depends on a tracing library: plug in OpenTelemetry or a profiler
+from a hook.
+
+    def hook(event):
+        if event.phase == 'end':
+            print(event.export, event.serial, event.duration, event.return_code)
+
+    sd.add_trace_hook(hook)
+"""
+from __future__ import annotations
+import itertools
+import logging
+import threading
+import time
+from contextvars import ContextVar
+from typing import Any, Callable, NamedTuple, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# The span id of the DLL call in flight in this context. Hooks can read it to link their own spans.
+current_span: ContextVar[Optional[int]] = ContextVar('pysdtoken_current_span', default=None)
+
+_span_ids = itertools.count(1)
+
+
+class TraceEvent(NamedTuple):
+    """
+    A start or end event for one DLL call
+    :param phase: 'start' or 'end'
+    :param export: the stauto32 export name (e.g. GetCurrentCode)
+    :param serial: the token serial the call was made for, if any
+    :param span_id: unique id of this call. The start and end events share it
+    :param parent_id: span id of the enclosing DLL call, if any
+    :param thread: name of the calling thread
+    :param start: time.perf_counter() when the call started
+    :param duration: seconds spent in the call (end events only)
+    :param return_code: what the export returned (end events only)
+    :param error: the exception the call raised (end events only)
+    """
+    phase: str
+    export: str
+    serial: Optional[str]
+    span_id: int
+    parent_id: Optional[int]
+    thread: str
+    start: float
+    duration: Optional[float] = None
+    return_code: Any = None
+    error: Optional[BaseException] = None
+
+
+TraceHook = Callable[[TraceEvent], Any]
+
+
+def _emit(hooks: Sequence[TraceHook], event: TraceEvent) -> None:
+    for hook in hooks:
+        try:
+            hook(event)
+        except Exception as e:
+            # A broken hook must never break a code fetch
+            logger.debug(e)
+            logger.error(f"Trace hook {hook} failed on {event.phase} of {event.export}")
+
+
+def traced_call(hooks: Sequence[TraceHook], func: Any, serial: Optional[str], args: Sequence[Any],
+                thread: Optional[str] = None) -> Any:
+    """
+    Call a DLL function and send start/end events to the hooks
+    :param hooks: the registered trace hooks
+    :param func: the ctypes function pointer (its __name__ is the export name)
+    :param serial: the token serial the call is for, or None
+    :param args: the arguments for the call
+    :param thread: name of the thread that asked for the call. Defaults to the current thread.
+    :return: whatever the call returned. Exceptions are re-raised after the end event.
+    """
+    span_id = next(_span_ids)
+    parent_id = current_span.get()
+    token = current_span.set(span_id)
+    start_event = TraceEvent(
+        phase='start',
+        export=getattr(func, '__name__', repr(func)),
+        serial=serial,
+        span_id=span_id,
+        parent_id=parent_id,
+        thread=thread if thread is not None else threading.current_thread().name,
+        start=time.perf_counter(),
+    )
+    _emit(hooks, start_event)
+    try:
+        return_code = func(*args)
+    except BaseException as e:
+        current_span.reset(token)
+        _emit(hooks, start_event._replace(phase='end', duration=time.perf_counter() - start_event.start, error=e))
+        raise
+    current_span.reset(token)
+    _emit(hooks, start_event._replace(phase='end', duration=time.perf_counter() - start_event.start,
+                                      return_code=return_code))
+    return return_code
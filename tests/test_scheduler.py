@@ -0,0 +1,44 @@
+import threading
+import unittest
+
+from pysdtoken import SDProcess
+from pysdtoken.loadtest import StandInBackend
+
+
+class NestedCallTest(unittest.TestCase):
+    def test_trace_hook_can_make_dll_calls_with_one_slot(self):
+        sd = SDProcess(backend=StandInBackend(token_count=2), max_concurrent_calls=1, log_level='CRITICAL')
+        errors = []
+
+        def hook(event):
+            if event.phase == 'end' and event.export == 'GetCurrentCode':
+                errors.append(sd.get_token_error())
+
+        sd.add_trace_hook(hook)
+        caller = threading.Thread(target=sd.tokens[0].get_current_code, daemon=True)
+        caller.start()
+        caller.join(5.0)
+
+        self.assertFalse(caller.is_alive(), "Nested DLL call deadlocked on the scheduler slot")
+        self.assertEqual(errors, ['No error'])
+        self.assertEqual(sd.scheduler_stats()['running'], 0)
+
+
+class ImportPriorityTest(unittest.TestCase):
+    def test_import_workers_keep_the_callers_request_options(self):
+        sd = SDProcess(backend=StandInBackend(token_count=2), max_concurrent_calls=1, log_level='CRITICAL')
+        before = sd.scheduler_stats()
+        tokens = [(f'<TKNBatch><TKN><SN>{900000000000 + n}</SN></TKN></TKNBatch>', None) for n in range(6)]
+
+        with sd.request_options(priority='batch', job='bulk-import'):
+            results = list(sd.import_tokens(tokens, max_workers=3))
+
+        after = sd.scheduler_stats()
+        self.assertEqual([result.status for result in results], ['imported'] * 6)
+        # One ImportToken per token, plus the two EnumToken calls of the re-enumeration when the import finishes
+        self.assertEqual(after['batch']['admitted'] - before['batch']['admitted'], 6 + 2)
+        self.assertEqual(after['interactive']['admitted'] - before['interactive']['admitted'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
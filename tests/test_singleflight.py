@@ -0,0 +1,82 @@
+import threading
+import time
+import unittest
+
+from pysdtoken import CallTimeoutError, DeadlineExceededError
+from pysdtoken._singleflight import SingleFlight
+
+
+class SingleFlightTest(unittest.TestCase):
+    def _callers(self, flight, func, count, deadline=None):
+        outcomes = []
+
+        def caller():
+            try:
+                outcomes.append(flight.do('key', func, deadline=deadline))
+            except Exception as e:
+                outcomes.append(e)
+
+        threads = [threading.Thread(target=caller) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        return threads, outcomes
+
+    def test_leader_call_timeout_reaches_followers_unchanged(self):
+        flight = SingleFlight()
+        started = threading.Event()
+
+        def leader_call():
+            started.set()
+            time.sleep(0.2)
+            raise CallTimeoutError("GetCurrentCode did not finish within 0.1 seconds")
+
+        leaders, led = self._callers(flight, leader_call, 1)
+        started.wait()
+        threads, outcomes = self._callers(flight, self.fail, 3)
+        for thread in threads + leaders:
+            thread.join()
+
+        self.assertEqual(len(outcomes), 3)
+        for outcome in led + outcomes:
+            self.assertIsInstance(outcome, CallTimeoutError)
+            self.assertNotIsInstance(outcome, DeadlineExceededError)
+
+    def test_follower_deadline_does_not_affect_the_leader(self):
+        flight = SingleFlight()
+        started = threading.Event()
+
+        def leader_call():
+            started.set()
+            time.sleep(0.2)
+            return 'code'
+
+        leaders, led = self._callers(flight, leader_call, 1)
+        started.wait()
+        threads, outcomes = self._callers(flight, self.fail, 1, deadline=time.monotonic() + 0.05)
+        for thread in threads + leaders:
+            thread.join()
+
+        self.assertIsInstance(outcomes[0], DeadlineExceededError)
+        self.assertEqual(led, ['code'])
+
+    def test_dropped_leader_hands_the_call_to_a_follower(self):
+        flight = SingleFlight()
+        started = threading.Event()
+
+        def leader_call():
+            started.set()
+            time.sleep(0.1)
+            raise DeadlineExceededError("Deadline passed before the interactive request could run")
+
+        leaders, led = self._callers(flight, leader_call, 1)
+        started.wait()
+        threads, outcomes = self._callers(flight, lambda: 'code', 1)
+        for thread in threads + leaders:
+            thread.join()
+
+        self.assertIsInstance(led[0], DeadlineExceededError)
+        self.assertEqual(outcomes, ['code'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import threading
+import time
+import unittest
+
+from pysdtoken import SDProcess, CallTimeoutError, QueueTimeoutError
+from pysdtoken._watchdog import DLLWatchdog
+from pysdtoken.loadtest import StandInBackend
+
+
+class SaturatedBackendTest(unittest.TestCase):
+    def test_healthy_but_saturated_backend_does_not_trip_the_breaker(self):
+        # 20 concurrent 200 ms calls on one worker queue for up to 4 s, well past the 1 s call timeout, but no call
+        # runs longer than 200 ms
+        backend = StandInBackend(token_count=20)
+        sd = SDProcess(backend=backend, call_timeout=1.0, failure_threshold=2, log_level='CRITICAL')
+        self.addCleanup(sd.close_service)
+        backend.latency = 0.2
+        errors = []
+
+        def requester(token):
+            try:
+                token.get_current_code()
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=requester, args=(token,)) for token in sd.tokens]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        stats = sd.watchdog.stats()
+        self.assertEqual(stats['state'], 'closed')
+        self.assertEqual(stats['timeouts'], 0)
+        self.assertEqual(stats['failures'], 0)
+        self.assertEqual(stats['abandoned_workers'], 0)
+        self.assertTrue(all(isinstance(e, QueueTimeoutError) for e in errors), errors)
+        self.assertEqual(stats['queue_timeouts'], len(errors))
+
+        backend.latency = 0.0
+        self.assertTrue(sd.tokens[0].get_current_code().tokencode)
+
+    def test_more_workers_drain_the_queue(self):
+        backend = StandInBackend(token_count=8)
+        sd = SDProcess(backend=backend, call_timeout=1.0, call_workers=8, log_level='CRITICAL')
+        self.addCleanup(sd.close_service)
+        backend.latency = 0.2
+        results = []
+        threads = [threading.Thread(target=lambda t=token: results.append(t.get_current_code()))
+                   for token in sd.tokens]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(results), 8)
+        self.assertTrue(all(result.tokencode for result in results))
+        self.assertEqual(sd.watchdog.stats()['queue_timeouts'], 0)
+
+
+class NestedCallTest(unittest.TestCase):
+    def test_trace_hook_can_make_dll_calls_on_the_worker(self):
+        sd = SDProcess(backend=StandInBackend(token_count=2), call_timeout=1.0, log_level='CRITICAL')
+        self.addCleanup(sd.close_service)
+        errors = []
+
+        def hook(event):
+            if event.phase == 'end' and event.export == 'GetCurrentCode':
+                errors.append(sd.get_token_error())
+
+        sd.add_trace_hook(hook)
+        self.assertTrue(sd.tokens[0].get_current_code().tokencode)
+        self.assertEqual(errors, ['No error'])
+        self.assertEqual(sd.watchdog.stats()['timeouts'], 0)
+
+
+class HungCallTest(unittest.TestCase):
+    def test_call_running_past_the_timeout_retires_its_worker_and_trips(self):
+        watchdog = DLLWatchdog(call_timeout=0.1, failure_threshold=1, reset_timeout=60.0)
+        self.addCleanup(watchdog.shutdown)
+
+        with self.assertRaises(CallTimeoutError) as raised:
+            watchdog.call(time.sleep, (0.5,), 'GetCurrentCode')
+        self.assertNotIsInstance(raised.exception, QueueTimeoutError)
+        self.assertEqual(watchdog.abandoned_workers, 1)
+        self.assertEqual(watchdog.breaker.state, 'open')
+
+    def test_call_that_starts_late_gets_its_full_timeout(self):
+        watchdog = DLLWatchdog(call_timeout=0.3, failure_threshold=1)
+        self.addCleanup(watchdog.shutdown)
+        first = threading.Thread(target=watchdog.call, args=(time.sleep, (0.2,)))
+        first.start()
+        time.sleep(0.05)
+
+        # Queued for ~0.15 s, then runs for 0.2 s: 0.35 s in total but only 0.2 s in the DLL
+        self.assertEqual(watchdog.call(lambda: (time.sleep(0.2), 1)[1], ()), 1)
+        first.join()
+        self.assertEqual(watchdog.timeouts, 0)
+        self.assertEqual(watchdog.breaker.state, 'closed')
+
+
+if __name__ == '__main__':
+    unittest.main()